@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+    micro-benchmark: kapp.policy.get_creds_from_request
+    against the previous implementation (one headers.get per field).
+
+    usage:
+        python bench/bench_creds.py [number]
+"""
+
+import os, sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from flask import Flask, request
+from paste.deploy.converters import asbool
+
+from kapp.policy import get_creds_from_request
+
+
+def legacy_get_creds_from_request(req):
+    headers = req.headers
+    identity_status = headers.get('x-identity-status', None) or \
+                        headers['x-service-identity-status']
+    if identity_status.lower() != 'confirmed':
+        return {
+            'identity_status': identity_status
+        }
+
+    token = headers.get('x-auth-token', None) or \
+                        headers.get('x-service-token', None)
+    domain_id = headers.get('x-domain-id', None) or \
+                        headers.get('x-service-domain-id', None)
+    domain_name = headers.get('x-domain-name', None) or \
+                        headers.get('x-service-domain-name', None)
+
+    project_id = headers.get('x-project-id', None) or \
+                        headers.get('x-service-project-id', None)
+    project_name = headers.get('x-project-name', None) or \
+                        headers.get('x-service-project-name', None)
+    project_domain_id = headers.get('x-project-domain-id', None) or \
+                        headers.get('x-service-project-domain-id', None)
+    project_domain_name = headers.get('x-project-domain-name', None) or \
+                        headers.get('x-service-project-domain-name', None)
+
+    user_id = headers.get('x-user-id', None) or \
+                        headers.get('x-service-user-id', None)
+    user_name = headers.get('x-user-name', None) or \
+                        headers.get('x-service-user-name') or \
+                        headers.get('x-user')
+    user_domain_id = headers.get('x-user-domain-id', None) or \
+                        headers.get('x-service-user-domain-id', None)
+    user_domain_name = headers.get('x-user-domain-name', None) or \
+                        headers.get('x-service-user-domain-name', None)
+
+    tenant_id = headers.get('x-tenant-id', None) or \
+                        headers.get('x-tenant')
+    tenant_name = headers.get('x-tenant-name', None)
+
+    roles = headers.get('x-roles', None) or \
+                        headers.get('x-service-roles', None)
+    is_admin = headers.get('x-is-admin-project', None)
+
+    assert token
+    creds = {
+        'token': {
+            'id': token
+        }
+    }
+
+    if domain_id is not None:
+        creds.setdefault('domain', {})['id'] = domain_id
+    if domain_name is not None:
+        creds.setdefault('domain', {})['name'] = domain_name
+
+    if project_id is not None:
+        creds.setdefault('project', {})['id'] = project_id
+    if project_name:
+        creds.setdefault('project', {})['name'] = project_name
+    if project_domain_id is not None:
+        creds.setdefault('project', {}).setdefault('domain', {})['id'] = project_domain_id
+    if project_domain_name is not None:
+        creds.setdefault('project', {}).setdefault('domain', {})['name'] = project_domain_name
+
+    if user_id is not None:
+        creds.setdefault('user', {})['id'] = user_id
+    if user_name is not None:
+        creds.setdefault('user', {})['name'] = user_name
+    if user_domain_id is not None:
+        creds.setdefault('user', {}).setdefault('domain', {})['id'] = user_domain_id
+    if user_domain_name is not None:
+        creds.setdefault('user', {}).setdefault('domain', {})['name'] = user_domain_name
+
+    if tenant_id is not None:
+        creds.setdefault('tenant', {})['id'] = tenant_id
+    if tenant_name is not None:
+        creds.setdefault('tenant', {})['name'] = tenant_name
+
+    if roles is not None:
+        creds['roles'] = roles.split(',')
+    if is_admin is not None:
+        creds['is_admin'] = asbool(is_admin)
+
+    creds['identity_status'] = identity_status
+
+    return creds
+
+
+# headers set by keystonemiddleware for a v3 token (no service catalog).
+HEADERS = {
+    'X-Identity-Status': 'Confirmed',
+    'X-Auth-Token': 'gAAAAABYxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxxx',
+    'X-Domain-Id': None,
+    'X-Project-Id': '2c6b6a8f3a2f4ac6b1b4a2f1e8c0d9e7',
+    'X-Project-Name': 'admin',
+    'X-Project-Domain-Id': 'default',
+    'X-Project-Domain-Name': 'Default',
+    'X-User-Id': '5f4dcc3b5aa765d61d8327deb882cf99',
+    'X-User-Name': 'admin',
+    'X-User-Domain-Id': 'default',
+    'X-User-Domain-Name': 'Default',
+    'X-Roles': 'admin,member,reader',
+    'X-Is-Admin-Project': 'True',
+    'Accept': 'application/json',
+    'User-Agent': 'python-keystoneclient',
+}
+
+
+def main(number=20000):
+    app = Flask(__name__)
+    headers = dict((k, v) for k, v in HEADERS.iteritems() if v is not None)
+
+    with app.test_request_context('/', headers=headers):
+        assert get_creds_from_request(request) == \
+               legacy_get_creds_from_request(request)
+
+        for name, func in [('legacy', legacy_get_creds_from_request),
+                           ('table-driven', get_creds_from_request)]:
+            cost = min(timeit.repeat(lambda: func(request), repeat=3, number=number))
+            print '%-14s %8.2f us/call' % (name, cost / number * 1e6)
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
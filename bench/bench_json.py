@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+    benchmark: json encoders of kapp.wrapper.json_response,
+    with payloads from 1KB to 10MB.
+    "legacy" is the previous code path: json.dumps(dict(data)).
+
+    usage:
+        python bench/bench_json.py
+"""
+
+import os, sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kapp.wrapper import json_encoders
+
+
+SIZES = [
+    ('1KB', 1 << 10),
+    ('10KB', 10 << 10),
+    ('100KB', 100 << 10),
+    ('1MB', 1 << 20),
+    ('10MB', 10 << 20),
+]
+
+RECORD = {
+    'id': '5f4dcc3b5aa765d61d8327deb882cf99',
+    'name': 'instance-0001',
+    'status': 'ACTIVE',
+    'enabled': True,
+    'size': 40960,
+    'ratio': 0.75,
+    'tags': ['web', 'prod'],
+    'project': {'id': '2c6b6a8f3a2f4ac6b1b4a2f1e8c0d9e7', 'name': 'admin'},
+}
+
+
+def make_payload(size):
+    record_size = len(json.dumps(RECORD))
+    count = max(1, size // record_size)
+    return {'items': [dict(RECORD, index=i) for i in xrange(count)]}
+
+
+def main():
+    encoders = [('legacy', lambda data: json.dumps(dict(data)))]
+    encoders.extend(sorted(json_encoders.items()))
+
+    print '%-8s' % 'payload' + ''.join('%14s' % name for name, f in encoders)
+    for label, size in SIZES:
+        data = make_payload(size)
+        number = max(1, (1 << 20) // size) * 5
+
+        row = []
+        for name, dumps in encoders:
+            cost = min(timeit.repeat(lambda: dumps(data), repeat=3, number=number))
+            row.append('%11.3f ms' % (cost / number * 1e3))
+        print '%-8s' % label + ''.join(row)
+
+
+if __name__ == '__main__':
+    main()
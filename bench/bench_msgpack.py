@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding:utf-8 -*-
+
+"""
+    benchmark: json vs msgpack for typical kapp responses,
+    encode / decode cost and payload size.
+
+    usage:
+        python bench/bench_msgpack.py
+"""
+
+import os, sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from kapp import wrapper
+from kapp.wrapper import dumps_json, dumps_msgpack
+
+
+RECORD = {
+    'id': '5f4dcc3b5aa765d61d8327deb882cf99',
+    'name': 'instance-0001',
+    'status': 'ACTIVE',
+    'enabled': True,
+    'size': 40960,
+    'ratio': 0.75,
+    'tags': ['web', 'prod'],
+    'project': {'id': '2c6b6a8f3a2f4ac6b1b4a2f1e8c0d9e7', 'name': 'admin'},
+}
+
+PAYLOADS = [
+    ('message', {'msg': 'test url handler'}),
+    ('error', {'error': {'message': 'policy checking failed', 'code': 403, 'title': 'Forbidden'}}),
+    ('object', {'item': RECORD}),
+    ('list-100', {'items': [dict(RECORD, index=i) for i in xrange(100)]}),
+    ('list-10000', {'items': [dict(RECORD, index=i) for i in xrange(10000)]}),
+]
+
+
+def measure(func, number):
+    return min(timeit.repeat(func, repeat=3, number=number)) / number * 1e6
+
+
+def main():
+    if wrapper.msgpack is None:
+        print 'msgpack is not installed.'
+        return
+
+    unpackb = wrapper.msgpack.unpackb
+
+    print '%-12s %10s %10s %12s %12s %12s %12s' % (
+        'payload', 'json B', 'msgpack B',
+        'json enc us', 'mp enc us', 'json dec us', 'mp dec us')
+    for name, data in PAYLOADS:
+        json_body = dumps_json(data)
+        mp_body = dumps_msgpack(data)
+        number = max(1, 200000 // len(json_body))
+
+        print '%-12s %10d %10d %12.1f %12.1f %12.1f %12.1f' % (
+            name, len(json_body), len(mp_body),
+            measure(lambda: dumps_json(data), number),
+            measure(lambda: dumps_msgpack(data), number),
+            measure(lambda: json.loads(json_body), number),
+            measure(lambda: unpackb(mp_body), number),
+        )
+
+
+if __name__ == '__main__':
+    main()
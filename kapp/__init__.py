@@ -1,7 +1,8 @@
 # -*- coding:utf-8 -*-
 
 from .app import app_factory
-from .server import server_factory, server_factory_dbg
+from .server import server_factory, server_factory_dbg, server_factory_eventlet
+from .compress import gzip_filter_factory
 from .utils.process_util import daemonized
 
 
@@ -10,13 +11,16 @@ from . import server
 from . import utils
 from . import rest
 from . import manage
+from . import compress
+from . import dispatcher
 
 
 
 
 __all__ = [
-    'app_factory', 'server_factory', 'server_factory_dbg', 
-    'app', 'server', 'utils', 'rest', 'manage'
+    'app_factory', 'server_factory', 'server_factory_dbg', 'server_factory_eventlet',
+    'gzip_filter_factory',
+    'app', 'server', 'utils', 'rest', 'manage', 'compress', 'dispatcher'
 ]
 
 
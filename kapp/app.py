@@ -8,6 +8,7 @@ from paste.deploy.converters import asbool
 
 
 from .policy import init_policy
+from .wrapper import set_json_encoder, init_error_responses
 from . import rest
 
 
@@ -48,7 +49,12 @@ def app_factory(default, **config):
                                u'\xf3\xd9\x0f\xd01\xac[' \
                                u'\x92;<P\xc1\x1c\xbf'
 
-    init_policy(app)
+    # json (default), simplejson, ujson
+    if 'JSON_ENCODER' in app.config:
+        set_json_encoder(app.config['JSON_ENCODER'])
+
+    init_error_responses(app)
+
     app.register_blueprint(rest.mod, url_prefix='/api/1.0')
 
 
@@ -81,7 +87,7 @@ def app_factory(default, **config):
     def dump_creds():
         test_dump()
         from .policy import get_creds_from_request
-        creds = get_creds_from_request(request)
+        creds = get_creds_from_request(request).resolve()
         print json.dumps(creds, indent=4)
         return jsonify(creds)
 
@@ -102,6 +108,30 @@ def app_factory(default, **config):
         print 'creds:', creds._get_current_object()
         return 'ok'
 
+    @app.route(r'/test/audit/', methods=['GET'])
+    def dump_audit():
+        audit = getattr(app, 'policy_audit', None)
+        if audit is None:
+            return jsonify({'enabled': False})
+        return jsonify({
+            'enabled': True,
+            'pending': len(audit.pending),
+            'dropped': audit.dropped,
+            'recent': audit.recent()
+        })
+
+    @app.route(r'/test/server/', methods=['GET'])
+    def dump_server():
+        from .dispatcher import dispatcher_state
+        state = dispatcher_state()
+        if state is None:
+            return jsonify({'adaptive': False})
+        state['adaptive'] = True
+        return jsonify(state)
+
+    # after all views are registered -> per-endpoint policy rules
+    init_policy(app)
+
     return app
 
 
@@ -0,0 +1,134 @@
+# -*- coding:utf-8 -*-
+
+"""
+    audit log of policy decisions.
+    decisions are queued in memory and written to file in batches
+    by a background thread, no file I/O on request path.
+"""
+
+import json
+import time
+import atexit
+import threading
+from collections import deque
+
+from .utils.thread_util import threaded, thread_alive
+
+
+_event_fields = (
+    'time', 'allowed', 'rule', 'method', 'path',
+    'user_id', 'project_id', 'remote_addr'
+)
+
+def event_to_dict(event):
+    return dict(zip(_event_fields, event))
+
+
+class AuditLog(object):
+    """
+        usage:
+            audit = AuditLog('/var/log/kapp_audit.log', capacity=4096)
+            audit.start()   # in serving process (threads do not survive fork)
+
+            audit.record(False, 'kapp:all', 'GET', '/api/1.0/test',
+                         'user id', 'project id', '10.0.0.1')
+
+            audit.recent()  # latest decisions, for inspection
+            audit.dropped   # number of events dropped because queue was full
+
+        events are appended to file as json lines.
+        deque.append/popleft are atomic, recording takes no lock
+        unless the queue is full.
+    """
+
+    def __init__(self, path, capacity=4096, recent_size=256, batch_size=512, interval=1.0):
+        """
+            input:
+                path -> log file
+                capacity -> max number of events waiting to be written.
+                recent_size -> number of latest events kept for recent()
+                batch_size -> max number of events per write.
+                interval -> seconds between flushes.
+        """
+        self.path = path
+        self.capacity = capacity
+        self.batch_size = batch_size
+        self.interval = interval
+
+        self.pending = deque()
+        self.recent_events = deque(maxlen=recent_size)
+        self.dropped = 0
+        self._drop_lock = threading.Lock()
+        self.writer = None
+
+    def record(self, allowed, rule, method, path, user_id=None, project_id=None, remote_addr=None):
+        """
+            output:
+                bool -> False if event is dropped.
+        """
+        event = (time.time(), allowed, rule, method, path,
+                 user_id, project_id, remote_addr)
+        self.recent_events.append(event)
+
+        if len(self.pending) >= self.capacity:
+            with self._drop_lock:
+                self.dropped += 1
+            return False
+
+        self.pending.append(event)
+        return True
+
+    def recent(self):
+        """
+            output:
+                [dict] -> latest events, oldest first.
+        """
+        return [event_to_dict(event) for event in list(self.recent_events)]
+
+    def flush(self):
+        """
+            write all pending events to file.
+            output:
+                int -> number of events written.
+        """
+        written = 0
+        popleft = self.pending.popleft
+        while True:
+            batch = []
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(popleft())
+            except IndexError:
+                pass
+
+            if not batch:
+                break
+
+            lines = [json.dumps(event_to_dict(event)) + '\n' for event in batch]
+            try:
+                with open(self.path, 'a') as f:
+                    f.writelines(lines)
+            except IOError as e:
+                print 'failed to write audit log %s: %s' % (self.path, e)
+                with self._drop_lock:
+                    self.dropped += len(batch)
+                break
+
+            written += len(batch)
+
+        return written
+
+    @threaded(name='policy_audit', daemon=True, green=True)
+    def _write_forever(self):
+        while True:
+            time.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        """
+            start background writer.
+        """
+        if self.writer is not None and thread_alive(self.writer):
+            return
+        self.writer = self._write_forever()
+        atexit.register(self.flush)
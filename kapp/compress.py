@@ -0,0 +1,214 @@
+# -*- coding:utf-8 -*-
+
+"""
+    wsgi middleware compressing responses (gzip, deflate)
+    according to Accept-Encoding, compressed chunk by chunk,
+    so streamed (generator) responses stay streamed.
+"""
+
+import zlib
+
+from .app import from_paste_config
+
+
+DEFAULT_CONTENT_TYPES = (
+    'application/json',
+    'application/javascript',
+    'application/xml',
+    'text/plain',
+    'text/html',
+    'text/css',
+    'text/xml',
+)
+
+# encoding -> wbits of zlib.compressobj
+_wbits = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS,
+}
+
+
+def choose_encoding(accept_encoding):
+    """
+        pick encoding from Accept-Encoding header, gzip is preferred.
+        usage:
+            choose_encoding('deflate, gzip;q=0.5')   # 'deflate'
+            choose_encoding('gzip;q=0, identity')   # None
+            choose_encoding('gzip;q=0, *')   # 'deflate'
+    """
+    qvalues = {}
+    for item in accept_encoding.lower().split(','):
+        parts = item.split(';')
+        coding = parts[0].strip()
+        q = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    q = float(value)
+                except ValueError as e:
+                    q = 0.0
+        qvalues[coding] = q
+
+    # '*' stands for codings not listed, refused ones (q=0) stay refused.
+    wildcard = qvalues.pop('*', None)
+    if wildcard is not None:
+        for coding in ('gzip', 'deflate'):
+            qvalues.setdefault(coding, wildcard)
+
+    best, best_q = None, 0.0
+    for coding in ('gzip', 'deflate'):
+        q = qvalues.get(coding, 0.0)
+        if q > best_q:
+            best, best_q = coding, q
+
+    return best
+
+
+def _encoded_etag(etag, encoding):
+    """
+        etag of compressed representation, distinct from that of identity one.
+        usage:
+            _encoded_etag('"abc"', 'gzip')     # '"abc-gzip"'
+            _encoded_etag('W/"abc"', 'gzip')   # 'W/"abc-gzip"'
+    """
+    etag = etag.strip()
+    if not etag.endswith('"'):
+        return etag
+    return '%s-%s"' % (etag[:-1], encoding)
+
+
+class GzipMiddleware(object):
+    """
+        usage:
+            app = GzipMiddleware(app, min_size=1024)
+
+        responses are compressed if:
+            client accepts gzip or deflate,
+            Content-Type is in content_types,
+            Content-Length is unknown (streamed) or >= min_size,
+            no Content-Encoding is set yet.
+        ETag of compressed responses gets a suffix of encoding (e.g. "abc-gzip"),
+        which is removed from If-None-Match before it reaches app.
+    """
+
+    def __init__(self, app, min_size=1024, compress_level=6, content_types=DEFAULT_CONTENT_TYPES):
+        self.app = app
+        self.min_size = int(min_size)
+        self.compress_level = int(compress_level)
+        if isinstance(content_types, basestring):
+            content_types = content_types.replace(',', ' ').split()
+        self.content_types = frozenset(t.lower() for t in content_types)
+
+    def _compressible(self, status, headers):
+        """
+            output:
+                (bool, bool) -> (varies on Accept-Encoding, should be compressed)
+        """
+        code = int(status.split(' ', 1)[0])
+        fields = dict((k.lower(), v) for k, v in headers)
+
+        content_type = fields.get('content-type', '').split(';')[0].strip().lower()
+        if content_type not in self.content_types:
+            return False, False
+
+        if code < 200 or code in (204, 304) or \
+           'content-encoding' in fields or \
+           'no-transform' in fields.get('cache-control', ''):
+            return True, False
+
+        length = fields.get('content-length')
+        if length is not None and length.isdigit() and int(length) < self.min_size:
+            return True, False
+
+        return True, True
+
+    def __call__(self, environ, start_response):
+        encoding = choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        # validators sent back by client are those of compressed representation,
+        # app compares them against its own.
+        suffix = '-%s"' % encoding
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        revalidating = bool(if_none_match) and suffix in if_none_match
+        if revalidating:
+            environ['HTTP_IF_NONE_MATCH'] = if_none_match.replace(suffix, '"')
+
+        state = {}
+
+        def _start_response(status, headers, exc_info=None):
+            vary, compress = self._compressible(status, headers)
+            state['compressor'] = None
+
+            if compress or (revalidating and status.startswith('304')):
+                headers = [(k, v) if k.lower() != 'etag' else (k, _encoded_etag(v, encoding))
+                           for k, v in headers]
+
+            if vary:
+                headers = list(headers)
+                for i, (k, v) in enumerate(headers):
+                    if k.lower() == 'vary':
+                        if 'accept-encoding' not in v.lower():
+                            headers[i] = (k, v + ', Accept-Encoding')
+                        break
+                else:
+                    headers.append(('Vary', 'Accept-Encoding'))
+
+            if compress:
+                headers = [(k, v) for k, v in headers if k.lower() != 'content-length']
+                headers.append(('Content-Encoding', encoding))
+                state['compressor'] = zlib.compressobj(
+                    self.compress_level, zlib.DEFLATED, _wbits[encoding])
+
+            write = start_response(status, headers, exc_info)
+            compressor = state['compressor']
+            if compressor is None:
+                return write
+
+            def compressed_write(data):
+                write(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))
+            return compressed_write
+
+        app_iter = self.app(environ, _start_response)
+        if 'compressor' in state and state['compressor'] is None:
+            # start_response is already called, nothing to compress.
+            return app_iter
+
+        return self._compress_iter(app_iter, state)
+
+    def _compress_iter(self, app_iter, state):
+        try:
+            for chunk in app_iter:
+                compressor = state.get('compressor')
+                if compressor is None:
+                    yield chunk
+                    continue
+
+                if chunk:
+                    # flush every chunk, so streamed responses are not held back.
+                    data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                    if data:
+                        yield data
+
+            compressor = state.get('compressor')
+            if compressor is not None:
+                yield compressor.flush()
+        finally:
+            close = getattr(app_iter, 'close', None)
+            if close is not None:
+                close()
+
+
+def gzip_filter_factory(default, **config):
+    """
+        paste-deploy filter factory
+            return a wrapper for GzipMiddleware
+    """
+    config = from_paste_config(config)
+
+    def filter(app):
+        return GzipMiddleware(app, **config)
+
+    return filter
@@ -8,3 +8,47 @@ from oslo_config import cfg
 
 # better make it read-only
 CONF = cfg.CONF
+
+
+# callbacks to run after config files are reloaded.
+_reload_callbacks = []
+
+def on_reload(callback):
+    """
+        register a callback for reload_config, can be used as decorator.
+    """
+    _reload_callbacks.append(callback)
+    return callback
+
+
+def reload_config():
+    """
+        reload config files (e.g. on SIGHUP),
+        and let registered callbacks rebuild what is derived from CONF.
+    """
+    CONF.reload_config_files()
+    for callback in _reload_callbacks:
+        callback()
+
+
+# set by signal handler, reload is done by serving loop (reload_if_requested).
+_reload_requested = [False]
+
+def request_reload():
+    """
+        ask for reload_config, safe in signal handlers:
+        callbacks take locks, which the interrupted thread may hold.
+    """
+    _reload_requested[0] = True
+
+
+def reload_if_requested():
+    """
+        output:
+            bool -> if config is reloaded.
+    """
+    if not _reload_requested[0]:
+        return False
+    _reload_requested[0] = False
+    reload_config()
+    return True
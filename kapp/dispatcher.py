@@ -0,0 +1,183 @@
+# -*- coding:utf-8 -*-
+
+"""
+    task dispatcher of waitress, whose thread count follows the load:
+    grows when requests wait in queue, shrinks when threads stay idle.
+"""
+
+import time
+from collections import deque
+
+from waitress.task import ThreadedTaskDispatcher
+
+from .utils.thread_util import threaded
+
+
+# dispatcher of this process, see dispatcher_state()
+_current = None
+
+
+class _QueuedTask(object):
+    """
+        proxy of a waitress task (channel), records how long it waits in queue.
+    """
+    __slots__ = ('task', 'queued_at', 'waits')
+
+    def __init__(self, task, waits):
+        self.task = task
+        self.queued_at = time.time()
+        self.waits = waits
+
+    def service(self):
+        self.waits.append(time.time() - self.queued_at)
+        return self.task.service()
+
+    def cancel(self):
+        return self.task.cancel()
+
+
+class AdaptiveTaskDispatcher(ThreadedTaskDispatcher):
+    """
+        usage:
+            dispatcher = AdaptiveTaskDispatcher(threads_min=4, threads_max=32)
+            server = create_server(app, _dispatcher=dispatcher)
+            dispatcher.start()  # in serving process (threads do not survive fork)
+
+        every interval seconds:
+            grow -> requests are queued beyond idle threads, or mean queue
+                    wait > wait_threshold, by number of those requests (at least 1).
+            shrink -> no queued request and some threads idle
+                      for idle_intervals checks in a row, by 1.
+    """
+
+    def __init__(self, threads_min=4, threads_max=16, wait_threshold=0.05,
+                 interval=1.0, idle_intervals=5):
+        super(AdaptiveTaskDispatcher, self).__init__()
+        self.threads_min = max(1, int(threads_min))
+        self.threads_max = max(self.threads_min, int(threads_max))
+        self.wait_threshold = wait_threshold
+        self.interval = interval
+        self.idle_intervals = idle_intervals
+
+        # queue waits of serviced tasks, consumed by monitor.
+        self.waits = deque()
+        self.thread_count = 0
+        self.idle_checks = 0
+        self.stopped = False
+        self.monitor = None
+        self.stats = {
+            'serviced': 0,
+            'wait_mean': 0.0,
+            'wait_max': 0.0,
+            'grown': 0,
+            'shrunk': 0,
+        }
+
+        self.resize(self.threads_min)
+
+        global _current
+        _current = self
+
+    def resize(self, count):
+        count = min(max(count, self.threads_min), self.threads_max)
+        if self.stopped:
+            return self.thread_count
+        if count != self.thread_count:
+            self.thread_count = count
+            self.set_thread_count(count)
+        return count
+
+    def add_task(self, task):
+        super(AdaptiveTaskDispatcher, self).add_task(_QueuedTask(task, self.waits))
+
+    def _collect_waits(self):
+        waits = []
+        popleft = self.waits.popleft
+        try:
+            while True:
+                waits.append(popleft())
+        except IndexError:
+            pass
+        return waits
+
+    def adjust(self):
+        """
+            one check of the monitor.
+            output:
+                int -> change of thread count.
+        """
+        waits = self._collect_waits()
+        wait_mean = sum(waits) / len(waits) if waits else 0.0
+        self.stats['serviced'] += len(waits)
+        self.stats['wait_mean'] = wait_mean
+        self.stats['wait_max'] = max(waits) if waits else 0.0
+
+        with self.lock:
+            queued = len(self.queue)
+            idle = len(self.threads) - self.stop_count - self.active_count
+
+        before = self.thread_count
+        if queued > idle or wait_mean > self.wait_threshold:
+            self.idle_checks = 0
+            self.resize(before + max(1, queued - max(idle, 0)))
+        elif idle > 0:
+            self.idle_checks += 1
+            if self.idle_checks >= self.idle_intervals:
+                self.idle_checks = 0
+                self.resize(before - 1)
+        else:
+            self.idle_checks = 0
+
+        change = self.thread_count - before
+        if change > 0:
+            self.stats['grown'] += 1
+        elif change < 0:
+            self.stats['shrunk'] += 1
+        return change
+
+    @threaded(name='thread_pool_monitor', daemon=True)
+    def _monitor_forever(self):
+        while not self.stopped:
+            time.sleep(self.interval)
+            if not self.stopped:
+                self.adjust()
+
+    def start(self):
+        """
+            start monitor thread.
+        """
+        if self.monitor is not None and self.monitor.is_alive():
+            return
+        self.monitor = self._monitor_forever()
+
+    def shutdown(self, cancel_pending=True, timeout=5):
+        self.stopped = True
+        return super(AdaptiveTaskDispatcher, self).shutdown(cancel_pending, timeout)
+
+    def state(self):
+        with self.lock:
+            queued = len(self.queue)
+            threads = len(self.threads) - self.stop_count
+            active = self.active_count
+
+        state = dict(self.stats)
+        state.update({
+            'threads': threads,
+            'active': active,
+            'idle': max(0, threads - active),
+            'queued': queued,
+            'threads_min': self.threads_min,
+            'threads_max': self.threads_max,
+        })
+        return state
+
+
+def dispatcher_state():
+    """
+        output:
+            dict -> state of adaptive thread pool of this process,
+                    None if threads are fixed.
+    """
+    if _current is None:
+        return None
+    return _current.state()
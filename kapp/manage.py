@@ -11,16 +11,24 @@
 #   run     [debug|production], host, port
 #   stop
 #   status
+#   reload  (start new process on the same socket, then retire the old one)
+#   manifest
 ##################################
 
 
-import sys
+import os, sys
+import signal
 import argparse
 import time
 from paste.deploy import loadserver, loadapp
+from paste.deploy.loadwsgi import loadcontext, SERVER
 
 from .config import CONF
-from .utils.process_util import daemonized
+from .server import set_reload_command, monkey_patch_for
+from .utils.process_util import daemonized, is_successor, on_ready
+
+# path of this script, to start a successor on reload.
+SCRIPT = os.path.abspath(sys.argv[0])
 
 
 
@@ -40,12 +48,32 @@ def load_wsgi(config_file, app_name='main', server_name='main'):
     global CONF
     CONF(default_config_files=[config_file])
 
+    # eventlet server: patch standard library before app is built.
+    context = loadcontext(SERVER, 'config:%s' % config_file, name=server_name)
+    monkey_patch_for(context.object, context.local_conf)
+
     app = loadapp('config:%s' % config_file, name=app_name)
     server = loadserver('config:%s' % config_file, name=server_name)
 
     return app, server
 
 
+def server_section(args):
+    if args.server:
+        return args.server
+    return 'werkzeug_simple' if args.debug else 'waitress'
+
+
+def reload_command(args):
+    """
+        command line of the successor started on reload.
+        it runs in place of the daemon, pid file is taken over once it serves.
+    """
+    argv = [sys.executable, SCRIPT, 'run', '--config', os.path.abspath(args.config)]
+    if args.server:
+        argv += ['--server', args.server]
+    return argv
+
 
 
 def start_server(args):
@@ -55,8 +83,9 @@ def start_server(args):
         return
 
     app_name = 'main'
-    server_name = 'werkzeug_simple' if args.debug else 'waitress'
+    server_name = server_section(args)
     app, server = load_wsgi(args.config, app_name=app_name, server_name=server_name)
+    set_reload_command(reload_command(args))
 
     wsgi_daemon.start(app, server)
     while not wsgi_daemon.running:
@@ -72,10 +101,19 @@ def run_server(args):
     global wsgi_daemon
 
     app_name = 'main'
-    server_name = 'werkzeug_simple' if args.debug else 'waitress'
+    server_name = server_section(args)
     app, server = load_wsgi(args.config, app_name=app_name, server_name=server_name)
+    set_reload_command(reload_command(args))
+
+    if is_successor():
+        # started by reload of daemon, take over its pid file once serving.
+        on_ready(wsgi_daemon.adopt)
 
-    wsgi_daemon.run(app, server)
+    try:
+        wsgi_daemon.run(app, server)
+    finally:
+        # removed only if owned.
+        wsgi_daemon.del_pid_file()
 
 def stop_server(args):
     global wsgi_daemon
@@ -90,11 +128,34 @@ def server_status(args):
     else:
         print 'not running'
 
+def reload_server(args):
+    global wsgi_daemon
+    if not wsgi_daemon.running:
+        print 'not running'
+        return
+
+    pid = wsgi_daemon.pid
+    wsgi_daemon.signal(signal.SIGUSR2)
+
+    deadline = time.time() + args.timeout
+    while time.time() < deadline:
+        if wsgi_daemon.pid not in (pid, None):
+            print 'reloaded, pid: %d -> %d' % (pid, wsgi_daemon.pid)
+            return
+        time.sleep(0.1)
+    print 'reload not finished in %ss, pid: %d' % (args.timeout, pid)
+
 def restart_server(args):
     global wsgi_daemon
     stop_server(args)
     start_server(args)
 
+def build_url_manifest(args):
+    from .rest.urls import build_manifest, MANIFEST
+    path = args.output or MANIFEST
+    manifest = build_manifest(path)
+    print 'routes: %d, saved to %s' % (len(manifest['routes']), path)
+
 def exe_cmd():
 
     # parser
@@ -106,12 +167,16 @@ def exe_cmd():
     parser_cmd_start.add_argument('--debug', dest='debug', action='store_true')
     parser_cmd_start.add_argument('--config', dest='config', action='store', 
                                   default='/etc/kapp/config.ini', metavar='PATH')
+    parser_cmd_start.add_argument('--server', dest='server', action='store', default=None,
+                                metavar='NAME', help='server section in config, e.g. eventlet')
     parser_cmd_start.set_defaults(func=start_server)
 
     parser_cmd_run = subparsers.add_parser('run', description='run in terminal')
     parser_cmd_run.add_argument('--debug', dest='debug', action='store_true')
     parser_cmd_run.add_argument('--config', dest='config', action='store', 
                                 default='/etc/kapp/config.ini', metavar='PATH')
+    parser_cmd_run.add_argument('--server', dest='server', action='store', default=None,
+                                metavar='NAME', help='server section in config, e.g. eventlet')
     parser_cmd_run.set_defaults(func=run_server)
 
     parser_cmd_stop = subparsers.add_parser('stop', description='stop daemon')
@@ -124,8 +189,22 @@ def exe_cmd():
     parser_cmd_restart.add_argument('--debug', dest='debug', action='store_true')
     parser_cmd_restart.add_argument('--config', dest='config', action='store', 
                                 default='/etc/kapp/config.ini', metavar='PATH')
+    parser_cmd_restart.add_argument('--server', dest='server', action='store', default=None,
+                                metavar='NAME', help='server section in config, e.g. eventlet')
     parser_cmd_restart.set_defaults(func=restart_server)
 
+    parser_cmd_reload = subparsers.add_parser('reload', 
+                                description='start new daemon on the same socket, then stop the old one')
+    parser_cmd_reload.add_argument('--timeout', dest='timeout', action='store', type=float,
+                                default=60, metavar='SECONDS')
+    parser_cmd_reload.set_defaults(func=reload_server)
+
+    parser_cmd_manifest = subparsers.add_parser('manifest', 
+                                description='save route manifest for faster startup')
+    parser_cmd_manifest.add_argument('--output', dest='output', action='store', 
+                                default=None, metavar='PATH')
+    parser_cmd_manifest.set_defaults(func=build_url_manifest)
+
 
 
     # parse
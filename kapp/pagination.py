@@ -0,0 +1,130 @@
+# -*- coding:utf-8 -*-
+
+"""
+    keyset (marker) pagination for list views.
+
+    usage:
+        from kapp.pagination import paginate, paginated_response
+
+        @lazy_app.route(r'/users', methods=['GET'])
+        def list_users():
+            # GET /users?limit=50&marker=<id of last user of previous page>
+            page = paginate(users, key=lambda user: user['id'])
+            return paginated_response(page, 'users')
+"""
+
+from itertools import islice, ifilter
+
+from flask import request, abort
+from werkzeug.urls import url_encode
+
+from .wrapper import data_response
+from .utils.cache import SqliteStore
+
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+
+def get_page_args(default_limit=DEFAULT_LIMIT, max_limit=MAX_LIMIT):
+    """
+        parse "limit" and "marker" of query string,
+        abort with 400 if limit is invalid.
+        output:
+            (int, str or None) -> limit, marker
+    """
+    try:
+        limit = int(request.args.get('limit', default_limit))
+    except ValueError:
+        abort(400)
+    if limit <= 0:
+        abort(400)
+
+    marker = request.args.get('marker') or None
+    return min(limit, max_limit), marker
+
+
+class Page(object):
+    def __init__(self, items, next_marker, limit):
+        """
+            input:
+                items -> items of this page
+                next_marker -> marker of next page, None if this is the last page.
+                limit -> page size
+        """
+        self.items = items
+        self.next_marker = next_marker
+        self.limit = limit
+
+    def next_url(self):
+        if self.next_marker is None:
+            return None
+        args = request.args.copy()
+        args['marker'] = self.next_marker
+        args['limit'] = self.limit
+        return '%s?%s' % (request.base_url, url_encode(args))
+
+
+def paginate(source, key=None, default_limit=DEFAULT_LIMIT, max_limit=MAX_LIMIT, filter_cond=None):
+    """
+        fetch one page of source according to query string,
+        one extra item is fetched to detect next page.
+        input:
+            source ->
+                SqliteStore: paged by record id.
+                callable: source(marker, limit) -> items after marker.
+                iterable: sorted items, skipped up to the one with key == marker.
+            key -> key(item) -> marker of item, default: item['id']
+                   (SqliteStore is paged by record id, key is not accepted)
+            filter_cond -> filter_cond(item) -> bool, items listed.
+                           (SqliteStore and iterable, callable source filters itself)
+        output:
+            Page
+    """
+    limit, marker = get_page_args(default_limit, max_limit)
+
+    if isinstance(source, SqliteStore):
+        assert key is None, 'SqliteStore is paged by record id, key is not supported'
+        if marker is not None and not marker.isdigit():
+            abort(400)
+        rows = source.page(limit + 1, int(marker) if marker else None, filter_cond)
+        items = [value for id, value in rows[:limit]]
+        next_marker = rows[limit - 1][0] if len(rows) > limit else None
+        return Page(items, next_marker, limit)
+
+    key = key or (lambda item: item['id'])
+
+    if callable(source):
+        assert filter_cond is None, 'callable source filters items itself'
+        rows = list(source(marker, limit + 1))
+    else:
+        it = iter(source)
+        if marker is not None:
+            for item in it:
+                if unicode(key(item)) == marker:
+                    break
+            else:
+                # marker not found
+                abort(400)
+        if filter_cond is not None:
+            it = ifilter(filter_cond, it)
+        rows = list(islice(it, limit + 1))
+
+    items = rows[:limit]
+    next_marker = key(items[-1]) if len(rows) > limit else None
+    return Page(items, next_marker, limit)
+
+
+def paginated_response(page, key='items', status=200, headers={}):
+    """
+        output:
+            {
+                <key>: [...],
+                <key>_links: [{"rel": "next", "href": "...?limit=..&marker=.."}]
+            }
+    """
+    data = {key: page.items}
+    next_url = page.next_url()
+    if next_url is not None:
+        data['%s_links' % key] = [{'rel': 'next', 'href': next_url}]
+    return data_response(data, status, headers)
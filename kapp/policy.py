@@ -4,111 +4,203 @@
     apply oslo.policy to flask app
 """
 
+import os, time
 import json
+import warnings
+import weakref
 from werkzeug.local import LocalProxy
 from paste.deploy.converters import asbool
+from werkzeug.exceptions import BadRequestKeyError
 from flask import current_app, request, _request_ctx_stack, abort
 from oslo_policy import policy
+from oslo_policy import _checks
 from oslo_config import cfg
 
-from .wrapper import json_response
+from .wrapper import ErrorResponses
+from .audit import AuditLog
+from .utils.cache import LRUCache
+from .utils.dict_util import FrozenDict
+from .utils.thread_util import threaded
 
-from .config import CONF
+from .config import CONF, on_reload
+
+
+def _header_env_key(header):
+    """
+        'x-user-id' -> 'HTTP_X_USER_ID'
+    """
+    return 'HTTP_' + header.upper().replace('-', '_')
+
+
+def _non_empty(value):
+    return value or None
+
+
+def _split_roles(value):
+    return value.split(',')
+
+
+# credential fields generated by keystonemiddleware:
+#   (path in creds, headers in order of preference, converter)
+# a header is used if it is not empty, otherwise the next one is tried.
+_creds_headers = (
+    (('domain', 'id'), ('x-domain-id', 'x-service-domain-id'), None),
+    (('domain', 'name'), ('x-domain-name', 'x-service-domain-name'), None),
+
+    (('project', 'id'), ('x-project-id', 'x-service-project-id'), None),
+    (('project', 'name'), ('x-project-name', 'x-service-project-name'), _non_empty),
+    (('project', 'domain', 'id'),
+        ('x-project-domain-id', 'x-service-project-domain-id'), None),
+    (('project', 'domain', 'name'),
+        ('x-project-domain-name', 'x-service-project-domain-name'), None),
+
+    (('user', 'id'), ('x-user-id', 'x-service-user-id'), None),
+    (('user', 'name'), ('x-user-name', 'x-service-user-name', 'x-user'), None),
+    (('user', 'domain', 'id'),
+        ('x-user-domain-id', 'x-service-user-domain-id'), None),
+    (('user', 'domain', 'name'),
+        ('x-user-domain-name', 'x-service-user-domain-name'), None),
+
+    (('tenant', 'id'), ('x-tenant-id', 'x-tenant'), None),
+    (('tenant', 'name'), ('x-tenant-name',), None),
+
+    (('roles',), ('x-roles', 'x-service-roles'), _split_roles),
+    (('is_admin',), ('x-is-admin-project',), asbool),
+)
+
+# precompiled: (parent path, leaf key, environ keys, converter)
+_creds_table = tuple(
+    (path[:-1], path[-1], tuple(_header_env_key(h) for h in headers), convert)
+    for path, headers, convert in _creds_headers
+)
+
+_identity_status_keys = (
+    _header_env_key('x-identity-status'),
+    _header_env_key('x-service-identity-status')
+)
+_token_keys = (
+    _header_env_key('x-auth-token'),
+    _header_env_key('x-service-token')
+)
+_service_catalog_key = _header_env_key('x-service-catalog')
+
+
+class Credentials(dict):
+    """
+        credential dict whose expensive values are computed on first access.
+
+        usage:
+            creds = Credentials(roles=['admin'])
+            creds.set_lazy('service_catalog', lambda: json.loads(raw))
+            'service_catalog' in creds  # True, not computed yet
+            creds['service_catalog']    # computed now, and stored.
+
+        note:
+            iteration, copy and json encoding only see computed values,
+            call resolve() first to compute all of them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Credentials, self).__init__(*args, **kwargs)
+        self.lazy = {}
+
+    def set_lazy(self, key, loader):
+        self.pop(key, None)
+        self.lazy[key] = loader
+
+    def __missing__(self, key):
+        loader = self.lazy.pop(key, None)
+        if loader is None:
+            raise KeyError(key)
+        value = self[key] = loader()
+        return value
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.lazy
+
+    has_key = __contains__
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def resolve(self):
+        """
+            compute all lazy values.
+        """
+        for key in self.lazy.keys():
+            self[key]
+        return self
+
+
+# decoded service catalogs, by token id.
+# the catalog of a token never changes,
+# cached catalogs are shared by requests -> do not modify them.
+_service_catalogs = LRUCache(maxsize=64, ttl=300)
+
+def _load_service_catalog(token, raw_catalog):
+    catalog = _service_catalogs.get(token)
+    if catalog is None:
+        catalog = json.loads(raw_catalog)
+        _service_catalogs.set(token, catalog)
+    return catalog
 
 
 def get_creds_from_request(req):
     """
         get credential info from http request headers -> (generated from keystonemiddleware)
         compatible with v2,v3
+        headers are read from wsgi environ in a single pass over _creds_table.
         input:
             req -> flask.request
     """
-    headers = req.headers
-    identity_status = headers.get('x-identity-status', None) or \
-                        headers['x-service-identity-status']
+    environ = req.environ
+
+    identity_status = environ.get(_identity_status_keys[0])
+    if not identity_status:
+        identity_status = environ.get(_identity_status_keys[1])
+        if identity_status is None:
+            raise BadRequestKeyError('x-service-identity-status')
+
     if identity_status.lower() != 'confirmed':
-        return {
+        return Credentials({
             'identity_status': identity_status
-        }
-
-    token = headers.get('x-auth-token', None) or \
-                        headers.get('x-service-token', None)
-    domain_id = headers.get('x-domain-id', None) or \
-                        headers.get('x-service-domain-id', None)
-    domain_name = headers.get('x-domain-name', None) or \
-                        headers.get('x-service-domain-name', None)
-
-    project_id = headers.get('x-project-id', None) or \
-                        headers.get('x-service-project-id', None)
-    project_name = headers.get('x-project-name', None) or \
-                        headers.get('x-service-project-name', None)
-    project_domain_id = headers.get('x-project-domain-id', None) or \
-                        headers.get('x-service-project-domain-id', None)
-    project_domain_name = headers.get('x-project-domain-name', None) or \
-                        headers.get('x-service-project-domain-name', None)
-
-    user_id = headers.get('x-user-id', None) or \
-                        headers.get('x-serice-user-id', None)
-    user_name = headers.get('x-user-name', None) or \
-                        headers.get('x-service-user-name') or \
-                        headers.get('x-user')
-    user_domain_id = headers.get('x-user-domain-id', None) or \
-                        headers.get('x-service-user-domain-id', None)
-    user_domain_name = headers.get('x-user-domain-name', None) or \
-                        headers.get('x-service-user-domain-name', None)
-
-    tenant_id = headers.get('x-tenant-id', None) or \
-                        headers.get('x-tenant')
-    tenant_name = headers.get('x-tenant-name', None)
-
-    roles = headers.get('x-roles', None) or \
-                        headers.get('x-service-roles', None)
-    is_admin = headers.get('x-is-admin-project', None)
-    service_catalog = headers.get('x-service-catalog', None)
+        })
 
+    token = environ.get(_token_keys[0]) or environ.get(_token_keys[1])
     assert token
-    creds = {
+    creds = Credentials({
         'token': {
             'id': token
-        }
-    }
-
-    if domain_id is not None:
-        creds.setdefault('domain', {})['id'] = domain_id
-    if domain_name is not None:
-        creds.setdefault('domain', {})['name'] = domain_name
-
-    if project_id is not None:
-        creds.setdefault('project', {})['id'] = project_id
-    if project_name:
-        creds.setdefault('project', {})['name'] = project_name
-    if project_domain_id is not None:
-        creds.setdefault('project', {}).setdefault('domain', {})['id'] = project_domain_id
-    if project_domain_name is not None:
-        creds.setdefault('project', {}).setdefault('domain', {})['name'] = project_domain_name
-
-    if user_id is not None:
-        creds.setdefault('user', {})['id'] = user_id
-    if user_name is not None:
-        creds.setdefault('user', {})['name'] = user_name
-    if user_domain_id is not None:
-        creds.setdefault('user', {}).setdefault('domain', {})['id'] = user_domain_id
-    if user_domain_name is not None:
-        creds.setdefault('user', {}).setdefault('domain', {})['name'] = user_domain_name
-
-    if tenant_id is not None:
-        creds.setdefault('tenant', {})['id'] = tenant_id
-    if tenant_name is not None:
-        creds.setdefault('tenant', {})['name'] = tenant_name
-
-    if roles is not None:
-        creds['roles'] = roles.split(',')
-    if is_admin is not None:
-        creds['is_admin'] = asbool(is_admin)
-    if service_catalog is not None:
-        creds['service_catalog'] = json.loads(service_catalog)
-
-    creds['identity_status'] = identity_status
+        },
+        'identity_status': identity_status
+    })
+
+    for parents, leaf, env_keys, convert in _creds_table:
+        for env_key in env_keys:
+            value = environ.get(env_key)
+            if value:
+                break
+
+        if value is None:
+            continue
+        if convert is not None:
+            value = convert(value)
+            if value is None:
+                continue
+
+        node = creds
+        for parent in parents:
+            node = node.get(parent) or node.setdefault(parent, {})
+        node[leaf] = value
+
+    # service catalog is large and rarely used, decode it on demand.
+    raw_catalog = environ.get(_service_catalog_key)
+    if raw_catalog is not None:
+        creds.set_lazy('service_catalog',
+                       lambda: _load_service_catalog(token, raw_catalog))
 
     return creds
 
@@ -162,32 +254,278 @@ def get_target_info():
 
     return target
 
-service_target_info = LocalProxy(get_target_info)
 
+# snapshot of get_target_info(), shared by all requests.
+_service_target = None
+
+@on_reload
+def refresh_target_info():
+    """
+        rebuild the service target snapshot from CONF.
+    """
+    global _service_target
+    _service_target = FrozenDict(get_target_info())
+    return _service_target
+
+
+def get_service_target():
+    """
+        output:
+            FrozenDict -> service target info, built once from CONF.
+    """
+    target = _service_target
+    if target is None:
+        target = refresh_target_info()
+    return target
+
+service_target_info = LocalProxy(get_service_target)
+
+
+def _freeze(value):
+    """
+        convert (nested) dict/list into hashable tuples.
+    """
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    return value
+
+
+# credential fields that never affect policy decisions,
+# but differ between tokens of the same user.
+_volatile_cred_keys = ('token', 'service_catalog')
+
+def creds_fingerprint(creds):
+    """
+        normalized, hashable form of creds.
+            token and service catalog are ignored,
+            roles are order-insensitive.
+    """
+    fingerprint = []
+    for k, v in creds.iteritems():
+        if k in _volatile_cred_keys:
+            continue
+        if k == 'roles':
+            v = tuple(sorted(v))
+        fingerprint.append((k, _freeze(v)))
+    fingerprint.sort()
+    return tuple(fingerprint)
+
+
+class PolicyDecisionCache(object):
+    """
+        cache results of enforcer.enforce,
+        keyed by (rule, credential fingerprint, target).
+        all cached decisions are dropped when enforcer reloads its rules.
+
+        usage:
+            decisions = PolicyDecisionCache(maxsize=1024, ttl=60)
+            decisions.enforce(enforcer, 'kapp:all', target, creds)
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        """
+            input:
+                maxsize -> max number of cached decisions, 0 to disable cache.
+                ttl -> seconds a decision stays valid, None for no expiry.
+        """
+        self.cache = LRUCache(maxsize, ttl) if maxsize > 0 else None
+        self._rules = None
+
+    def enforce(self, enforcer, rule, target, creds):
+        if self.cache is None:
+            return enforcer.enforce(rule, target, creds)
+
+        # reload policy file if it is modified,
+        # which creates a new rules object.
+        enforcer.load_rules()
+        if enforcer.rules is not self._rules:
+            self.cache.clear()
+            self._rules = enforcer.rules
+
+        target_key = target if isinstance(target, FrozenDict) \
+                            else _freeze(dict(target))
+        key = (rule, creds_fingerprint(creds), target_key)
+        result = self.cache.get(key)
+        if result is None:
+            result = enforcer.enforce(rule, target, creds)
+            self.cache.set(key, result)
+        return result
+
+
+
+def compile_policy_rules(app, default_rule):
+    """
+        map endpoints of app to their policy rules,
+        views declare a rule with attribute `policy_rule`
+        (UrlRuleCache.route(..., policy_rule='kapp:xxx')).
+        output:
+            {endpoint: rule}
+    """
+    return dict(
+        (endpoint, getattr(view, 'policy_rule', default_rule))
+        for endpoint, view in app.view_functions.iteritems()
+    )
+
+
+def compile_exempt_paths(paths):
+    """
+        input:
+            paths -> path prefixes, list or str separated by space/comma.
+        output:
+            tuple -> used as `path.startswith(exempt_paths)`
+    """
+    if isinstance(paths, basestring):
+        paths = paths.replace(',', ' ').split()
+    return tuple(paths)
+
+
+def load_enforcer(frozen=True):
+    """
+        build an Enforcer and load rules from policy files.
+        input:
+            frozen -> if True, enforce() never re-reads policy files,
+                      new rules are loaded by reload_policy.
+        raise:
+            ValueError -> policy file is invalid.
+    """
+    enforcer = policy.Enforcer(CONF)
+    enforcer.load_rules()
+    if frozen:
+        # load_rules (called by every enforce) re-reads modified
+        # policy files only when use_conf is set.
+        enforcer.use_conf = False
+    return enforcer
+
+
+def reload_policy(app):
+    """
+        load policy files into a new Enforcer,
+        and replace app.policy_enforcer with it.
+        current rules stay in place if policy files are invalid.
+        output:
+            bool -> if new rules are applied.
+    """
+    try:
+        enforcer = load_enforcer()
+    except Exception as e:
+        print 'failed to reload policy, keep current rules: %s' % e
+        return False
+
+    if not enforcer.rules:
+        print 'failed to reload policy, keep current rules: no rules loaded'
+        return False
+
+    # rebinding an attribute is atomic,
+    # requests see either old or new enforcer.
+    app.policy_enforcer = enforcer
+    print 'policy reloaded: %s' % enforcer.policy_path
+    return True
+
+
+def _get_mtime(path):
+    try:
+        return os.path.getmtime(path)
+    except (OSError, TypeError) as e:
+        return None
+
+
+def watch_policy(app, interval):
+    """
+        start a daemon thread,
+        which reloads policy every time policy file is modified.
+        output:
+            threading.Thread
+    """
+    @threaded(name='policy_watcher', daemon=True, green=True)
+    def watcher():
+        path = app.policy_enforcer.policy_path
+        mtime = _get_mtime(path)
+        while True:
+            time.sleep(interval)
+            new_mtime = _get_mtime(path)
+            if new_mtime != mtime:
+                mtime = new_mtime
+                reload_policy(app)
+
+    return watcher()
 
 
 def init_policy(app):
     """
+        should be called after all views are registered,
+        views registered later are checked against the overall rule.
         input:
             app -> flask app
 
         output:
             app.policy_enforcer
+            app.policy_rules
+            app.policy_audit -> None if audit log is not configured.
     """
     init_target_conf()
     if not CONF.policy_target.enabled:
         return
 
-    enforcer = policy.Enforcer(CONF)
-    enforcer.load_rules()
-    app.policy_enforcer = enforcer
-
+    refresh_target_info()
+
+    # seconds between checks of policy file, 0 to reload on request path.
+    reload_interval = app.config.get('POLICY_RELOAD_INTERVAL', 5)
+
+    app.policy_enforcer = load_enforcer(frozen=bool(reload_interval))
+    app.policy_decisions = PolicyDecisionCache(
+        app.config.get('POLICY_CACHE_SIZE', 1024),
+        app.config.get('POLICY_CACHE_TTL', 60)
+    )
+    if not getattr(app, 'policy_reload_registered', False):
+        # once per app, by weak reference: callbacks are process-global,
+        # and should not keep apps alive.
+        app.policy_reload_registered = True
+        app_ref = weakref.ref(app)
+
+        @on_reload
+        def reload_app_policy():
+            app = app_ref()
+            if app is not None:
+                reload_policy(app)
+
+    audit_path = app.config.get('POLICY_AUDIT_LOG')
+    app.policy_audit = AuditLog(
+        audit_path,
+        capacity=app.config.get('POLICY_AUDIT_BUFFER', 4096),
+        interval=app.config.get('POLICY_AUDIT_INTERVAL', 1.0)
+    ) if audit_path else None
+
+    # threads do not survive fork (daemon, workers),
+    # start them in the serving process.
+    # green threads in eventlet server, flask holds a lock
+    # (not patched) while calling this.
+    @app.before_first_request
+    def start_policy_threads():
+        if reload_interval:
+            app.policy_watcher = watch_policy(app, reload_interval)
+        if app.policy_audit is not None:
+            app.policy_audit.start()
+
+
+    serv_name = 'kapp'
+    overall_op = 'all'
+    overall_rule = '%s:%s' % (serv_name, overall_op)
+    app.policy_rules = compile_policy_rules(app, overall_rule)
+
+    errors = getattr(app, 'error_responses', None) or ErrorResponses()
+
+    # requests to these paths (e.g. health checks) are not checked at all.
+    exempt_paths = compile_exempt_paths(app.config.get('POLICY_EXEMPT_PATHS', ()))
 
     @app.before_request
     def check_policy():
-        serv_name = 'kapp'
-        overall_op = 'all'
-        overall_rule = '%s:%s' % (serv_name, overall_op)
+        if exempt_paths and request.path.startswith(exempt_paths):
+            _request_ctx_stack.top.creds = None
+            return
+
+        rule = app.policy_rules.get(request.endpoint, overall_rule)
 
         # get credential from headers
         creds = get_creds_from_request(request)
@@ -195,15 +533,21 @@ def init_policy(app):
         # store creds in request context, for other usage
         _request_ctx_stack.top.creds = creds    
 
-        if not enforcer.enforce(overall_rule, service_target_info, creds):
+        allowed = app.policy_decisions.enforce(app.policy_enforcer, rule,
+                                               get_service_target(), creds)
+
+        audit = app.policy_audit
+        if audit is not None:
+            audit.record(
+                allowed, rule, request.method, request.path,
+                creds.get('user', {}).get('id'),
+                creds.get('project', {}).get('id'),
+                request.remote_addr
+            )
+
+        if not allowed:
             # abort(403, 'policy checking failed.')
-            return json_response({
-                "error": {
-                    "message": "policy checking failed",
-                    "code": 403, 
-                    "title": "Forbidden"
-                }
-            }, 403)
+            return errors.response(403)
 
 
 def _get_enforcer():
@@ -214,3 +558,71 @@ def _get_creds():
     return _request_ctx_stack.top.creds
 creds = LocalProxy(_get_creds)
 
+
+
+def enforce_many(rule, targets, creds=None):
+    """
+        check one rule against many targets with the same credential,
+        rule is looked up once -> for filtering list responses.
+        input:
+            rule -> rule name, e.g. 'kapp:get_user'
+            targets -> iterable of target dicts
+            creds -> default: creds of current request
+        output:
+            [bool] -> mask aligned with targets, all False without credential.
+            scope_types of rule are checked as enforcer.enforce does
+            (InvalidScope is raised if oslo_policy.enforce_scope is set).
+        usage:
+            from itertools import compress
+            mask = enforce_many('kapp:get_user', users)
+            return json_response({'users': list(compress(users, mask))})
+    """
+    enforcer = getattr(current_app, 'policy_enforcer', None)
+    if enforcer is None:
+        # policy is disabled
+        return [True for target in targets]
+
+    if creds is None:
+        creds = _get_creds()
+    if creds is None:
+        # exempt path, or no credential in request.
+        return [False for target in targets]
+
+    enforcer.load_rules()
+    try:
+        check = enforcer.rules[rule] if enforcer.rules else None
+    except KeyError:
+        check = None
+
+    if check is None:
+        # unknown rule -> fail closed, as enforcer.enforce does.
+        return [False for target in targets]
+
+    _check_scope(enforcer, rule, creds)
+    return [bool(_checks._check(rule=check, target=target, creds=creds,
+                                enforcer=enforcer, current_rule=rule))
+            for target in targets]
+
+
+def _check_scope(enforcer, rule, creds):
+    """
+        scope check of enforcer.enforce (scope_types of registered rule),
+        raises InvalidScope if enforce_scope is set, warns otherwise.
+    """
+    registered_rule = enforcer.registered_rules.get(rule)
+    if not registered_rule or not registered_rule.scope_types:
+        return
+
+    if creds.get('system'):
+        token_scope = 'system'
+    elif creds.get('domain_id'):
+        token_scope = 'domain'
+    else:
+        token_scope = 'project'
+
+    if token_scope in registered_rule.scope_types:
+        return
+    if enforcer.conf.oslo_policy.enforce_scope:
+        raise policy.InvalidScope(rule, registered_rule.scope_types, token_scope)
+    warnings.warn('Policy %s failed scope check, token is %s scoped but the policy '
+                  'requires %s scope.' % (rule, token_scope, registered_rule.scope_types))
@@ -2,24 +2,87 @@
 
 """
     this package contain all url rules' definition.
+
+    route manifest (optional):
+        `kapp_manage manifest` writes rules of all url modules to manifest.json,
+        then routes are registered from manifest,
+        and url modules are imported on first request to their endpoints.
+        manifest is ignored once any url module is added or modified.
 """
 
 import os, importlib
+import json
+import warnings
 from .lazy import lazy_app
 
 
 
 CUR_DIR = os.path.dirname(os.path.abspath(__file__))
 
+MANIFEST = os.path.join(CUR_DIR, 'manifest.json')
+
+
+def url_module_names():
+    """
+        names of submodules whose name starts with "url_"
+        these modules contain registered url rules.
+    """
+    return sorted(mn[:-3]
+                  for mn in os.listdir(CUR_DIR) \
+                  if mn.startswith('url_') and mn.endswith('.py'))
+
+
+def import_url_modules():
+    for mn in url_module_names():
+        importlib.import_module('.%s' % mn, __package__)
+
+
+def build_manifest(path=MANIFEST):
+    """
+        import all url modules, and save their rules to path.
+        output:
+            dict -> manifest
+    """
+    import_url_modules()
+    manifest = {
+        'modules': url_module_names(),
+        'routes': lazy_app.manifest()
+    }
+    with open(path, 'w') as f:
+        json.dump(manifest, f, indent=4)
+    return manifest
+
+
+def load_manifest(path=MANIFEST):
+    """
+        output:
+            [dict] -> routes in manifest
+            None -> no manifest, or it is outdated.
+    """
+    try:
+        mtime = os.path.getmtime(path)
+    except OSError as e:
+        return None
+
+    names = url_module_names()
+    for mn in names:
+        if os.path.getmtime(os.path.join(CUR_DIR, mn + '.py')) > mtime:
+            warnings.warn('route manifest is outdated: %s' % path)
+            return None
+
+    with open(path, 'r') as f:
+        manifest = json.load(f)
+    if manifest['modules'] != names:
+        warnings.warn('route manifest is outdated: %s' % path)
+        return None
 
-# import all submodules whose name starts with "url_"
-# these modules contain registered url rules.
-url_mod_names = [".%s" % mn[:-3]
-                 for mn in os.listdir(CUR_DIR) \
-                 if mn.startswith('url_') and mn.endswith('.py')]
-for mn in url_mod_names:
-    importlib.import_module(mn, __package__)
+    return manifest['routes']
 
 
 def attach_url(app):
-    lazy_app.attach(app)
+    routes = load_manifest()
+    if routes is None:
+        import_url_modules()
+        lazy_app.attach(app)
+    else:
+        lazy_app.attach_manifest(app, routes)
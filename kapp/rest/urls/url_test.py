@@ -6,15 +6,15 @@
 
 from flask import request
 
-from kapp.wrapper import json_response, empty_json_response
+from kapp.wrapper import json_response, empty_json_response, data_response
 
 from .lazy import lazy_app
 
 
-@lazy_app.route(r'/test', methods=['GET'])
+@lazy_app.route(r'/test', methods=['GET'], policy_rule='kapp:test')
 def all_users():
     if request.method == 'GET':
-        return json_response({'msg': 'test url handler'})
+        return data_response({'msg': 'test url handler'})
     else:
         raise Exception, 'not possible'
 
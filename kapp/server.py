@@ -1,12 +1,33 @@
 # -*- coding:utf-8 -*-
 
+import os
+import time
+import random
 import signal
-from waitress import serve
+import itertools
+import socket
+from waitress import create_server
+from waitress.server import BaseWSGIServer
+from waitress.channel import HTTPChannel
+from waitress import wasyncore
 from werkzeug.serving import run_simple
 from paste.deploy.converters import asbool
 
-from .utils.process_util import SignalContext
+try:
+    import eventlet
+    import eventlet.hubs
+    import eventlet.greenio
+    import eventlet.wsgi
+    import greenlet
+except ImportError, e:
+    eventlet = None
+
+from .utils.process_util import SignalContext, Prefork, Handoff, inherited_sockets, notify_ready
+from .utils.process_util import register_socket_file, remove_stale_socket, get_rss
+from .utils.thread_util import threaded
 from .app import from_paste_config
+from .dispatcher import AdaptiveTaskDispatcher
+from .config import request_reload, reload_if_requested
 
 
 class Termination(BaseException):
@@ -18,22 +39,365 @@ signal_context = SignalContext()
 def terminate(sig, stack):
     raise Termination, "terminated by signal %d" % sig
 
+@signal_context.on(signal.SIGHUP)
+def reload(sig, stack):
+    # done by serving loop, not in signal handler.
+    request_reload()
+
+
+# command line of the successor started on SIGUSR2, set by kapp_manage.
+reload_command = None
+
+def set_reload_command(argv):
+    global reload_command
+    reload_command = list(argv)
+
+def start_successor(sockets):
+    """
+        start a new process serving on the same listening sockets.
+        output:
+            Handoff -> None if reload is not supported.
+    """
+    if not reload_command:
+        print 'reload is not supported, server is not started by kapp_manage'
+        return None
+    handoff = Handoff(reload_command, sockets).start()
+    print 'starting successor (pid %d): %s' % (handoff.pid, ' '.join(reload_command))
+    return handoff
+
+
+# not defined by socket module of python 2, value on linux.
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def make_listen_socket(host, port, reuse_port=False, backlog=1024):
+    """
+        open a listening tcp socket.
+        input:
+            reuse_port -> set SO_REUSEPORT, so sockets of several processes
+                          can be bound to the same address, kernel balances
+                          connections between them.
+    """
+    family, socktype, proto, _, addr = socket.getaddrinfo(
+        host, port, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE)[0]
+
+    sock = socket.socket(family, socktype, proto)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(addr)
+    sock.listen(backlog)
+    return sock
+
+
+class GracefulServer(object):
+    """
+        waitress server shut down gracefully on SIGTERM:
+            1. stop accepting connections, listening sockets are closed.
+            2. close idle (keep-alive) connections, and connections
+               as soon as their response is sent.
+            3. wait for active requests up to shutdown_timeout seconds.
+        reload on SIGUSR2 (if reloadable):
+            a successor inheriting the listening sockets is started,
+            this server drains as above once the successor is ready.
+        recycling (worker of pre-fork master, which forks a new one):
+            drains as above and exits after max_requests (+ random jitter)
+            requests, or once its resident memory exceeds max_rss_mb.
+        usage:
+            GracefulServer(app, shutdown_timeout=30, host='0.0.0.0', port=8020).run()
+    """
+
+    def __init__(self, application, shutdown_timeout=30, reloadable=True,
+                 threads_min=None, threads_max=None, threads_wait_ms=50, threads_interval=1,
+                 max_requests=0, max_requests_jitter=0, max_rss_mb=0, **config):
+        # adaptive thread pool if threads_max is set, otherwise fixed (threads)
+        self.dispatcher = None
+        if threads_max:
+            self.dispatcher = AdaptiveTaskDispatcher(
+                threads_min=threads_min or config.get('threads', 4),
+                threads_max=threads_max,
+                wait_threshold=threads_wait_ms / 1000.0,
+                interval=threads_interval
+            )
+            config['_dispatcher'] = self.dispatcher
+
+        # jitter, so workers started together are not recycled together.
+        # Random() is seeded from os.urandom, module random is the same in forked workers.
+        self.max_requests = max_requests
+        if max_requests and max_requests_jitter:
+            self.max_requests += random.Random().randint(0, max_requests_jitter)
+        self.max_rss = max_rss_mb * 1024 * 1024
+        self.next_recycle_check = 0
+        self.request_counter = itertools.count()
+        self.request_count = 0
+        if self.max_requests:
+            application = self.counted(application)
+
+        self.server = create_server(application, **config)
+        self.adj = self.server.adj
+        # MultiSocketServer if listening on several sockets.
+        self.map = getattr(self.server, 'map', None) or self.server._map
+        self.shutdown_timeout = shutdown_timeout
+        # seconds to wait for the first request of a new connection while draining.
+        self.first_request_timeout = 1.0
+        self.reloadable = reloadable
+        self.stopping = False
+        self.reloading = False
+        self.handoff = None
+
+        self.signal_context = SignalContext({
+            signal.SIGTERM: self.stop,
+            signal.SIGHUP: reload,
+            signal.SIGUSR2: self.reload,
+        })
+
+    def stop(self, sig=None, stack=None):
+        self.stopping = True
+
+    def reload(self, sig=None, stack=None):
+        self.reloading = True
+
+    def check_handoff(self):
+        if self.reloading:
+            self.reloading = False
+            if not self.reloadable:
+                print 'reload is handled by master process'
+            elif self.handoff is None:
+                self.handoff = start_successor([l.socket for l in self.listeners()])
+
+        if self.handoff is None:
+            return
+
+        ready = self.handoff.poll()
+        if ready:
+            print 'successor (pid %d) is ready, stopping' % self.handoff.pid
+            self.stopping = True
+        elif ready is not None:
+            print 'successor (pid %d) failed, keep running' % self.handoff.pid
+            self.handoff = None
+
+    def counted(self, application):
+        counter = self.request_counter
+        def counted_app(environ, start_response):
+            # itertools.count is atomic under GIL, no lock needed.
+            self.request_count = next(counter) + 1
+            return application(environ, start_response)
+        return counted_app
+
+    def check_recycle(self):
+        reason = None
+        if self.max_requests and self.request_count >= self.max_requests:
+            reason = '%d requests served' % self.request_count
+        elif self.max_rss and time.time() >= self.next_recycle_check:
+            # rss is read from /proc, at most once a second.
+            self.next_recycle_check = time.time() + 1
+            rss = get_rss()
+            if rss is not None and rss > self.max_rss:
+                reason = 'rss %.1fMB > %.1fMB' % (rss / 1048576.0, self.max_rss / 1048576.0)
+
+        if reason is not None:
+            print 'recycling worker (pid %d): %s' % (os.getpid(), reason)
+            self.stopping = True
+
+    def listeners(self):
+        return [d for d in self.map.values() if isinstance(d, BaseWSGIServer)]
+
+    def channels(self):
+        return [d for d in self.map.values() if isinstance(d, HTTPChannel)]
+
+    def poll(self, timeout):
+        wasyncore.loop(timeout=timeout, map=self.map,
+                       use_poll=self.adj.asyncore_use_poll, count=1)
+
+    def run(self):
+        self.server.print_listen('Serving on http://{}:{}')
+        if self.dispatcher is not None:
+            self.dispatcher.start()
+        with self.signal_context:
+            notify_ready()
+            try:
+                while not self.stopping:
+                    # poll for successor more often while reloading.
+                    timeout = self.adj.asyncore_loop_timeout if self.handoff is None else 0.1
+                    self.poll(timeout)
+                    reload_if_requested()
+                    if self.reloading or self.handoff is not None:
+                        self.check_handoff()
+                    if self.max_requests or self.max_rss:
+                        self.check_recycle()
+                self.drain()
+            except KeyboardInterrupt as e:
+                pass
+            finally:
+                self.server.task_dispatcher.shutdown()
+                wasyncore.close_all(self.map)
+
+    def drain(self):
+        """
+            output:
+                bool -> if all requests are finished in time.
+        """
+        started = time.time()
+        deadline = started + self.shutdown_timeout
+
+        for listener in self.listeners():
+            listener.accepting = False
+            listener.del_channel()
+            listener.socket.close()
+
+        total = len(self.channels())
+        print 'draining %d connection(s), timeout %ss' % (total, self.shutdown_timeout)
+
+        while True:
+            active = 0
+            now = time.time()
+            for channel in self.channels():
+                if channel.requests or channel.request is not None or channel.total_outbufs_len:
+                    active += 1
+                elif channel.last_activity == channel.creation_time and \
+                     now - channel.creation_time < self.first_request_timeout:
+                    # accepted just before listeners were closed,
+                    # wait for its request instead of closing it.
+                    active += 1
+                else:
+                    # closed in next poll, channel is writable once will_close is set.
+                    channel.will_close = True
+
+            if not active and not self.channels():
+                break
+            if time.time() >= deadline:
+                break
+            self.poll(0.05)
+
+        elapsed = time.time() - started
+        if active:
+            print 'drain timed out after %.3fs, %d of %d connection(s) still active' % (
+                elapsed, active, total)
+        else:
+            print 'drained %d connection(s) in %.3fs' % (total, elapsed)
+        return not active
+
+
+def make_unix_socket(path, perms=0600, backlog=1024):
+    """
+        open a listening unix socket.
+        socket file left by a killed server is removed,
+        but not one a running server listens on.
+    """
+    remove_stale_socket(path)
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(path)
+    os.chmod(path, perms)
+    sock.listen(backlog)
+    return sock
+
+
+def serve_waitress(application, unix_socket=None, unix_socket_perms=0600, **config):
+    sockets = inherited_sockets()
+    if not sockets and unix_socket:
+        sockets = [make_unix_socket(unix_socket, unix_socket_perms, config.get('backlog', 1024))]
+
+    if sockets:
+        # started by reload (sockets of predecessor), or unix socket.
+        config.pop('host', None)
+        config.pop('port', None)
+        config['sockets'] = sockets
+
+    GracefulServer(application, **config).run()
+    print 'end'
+
+
+def serve_prefork(application, workers, reuse_port=False,
+                  unix_socket=None, unix_socket_perms=0600, **config):
+    """
+        pre-fork mode: master process forks workers,
+        each worker runs a waitress server on the listening socket.
+        input:
+            reuse_port -> False: socket is opened by master and shared by workers.
+                          True: each worker opens its own socket (SO_REUSEPORT).
+    """
+    host = config.pop('host', '0.0.0.0')
+    port = config.pop('port', 8080)
+    backlog = config.get('backlog', 1024)
+    # workers are killed if not drained in time.
+    kill_timeout = config.get('shutdown_timeout', 30) + 5
+
+    sock = None
+    inherited = inherited_sockets()
+    if inherited:
+        # started by reload, serve on socket of predecessor.
+        sock = inherited[0]
+    elif unix_socket:
+        sock = make_unix_socket(unix_socket, unix_socket_perms, backlog)
+    elif not reuse_port:
+        sock = make_listen_socket(host, port, backlog=backlog)
+
+    def worker(no):
+        listener = sock or make_listen_socket(host, port, reuse_port=True, backlog=backlog)
+        serve_waitress(application, reloadable=False, sockets=[listener], **config)
+
+    def successor():
+        return start_successor([sock] if sock is not None else [])
+
+    address = unix_socket or '%s:%s' % (host, port)
+    print 'master pid: %d, %d workers on %s' % (os.getpid(), workers, address)
+    # each worker holds its own copy of the listening socket, and closes it
+    # when draining (GracefulServer.drain). master drops its copy too,
+    # otherwise the socket stays open after workers close theirs,
+    # and new connections queue in its backlog, never accepted.
+    on_stop = sock.close if sock is not None else None
+    Prefork(worker, workers=workers, shutdown_timeout=kill_timeout,
+            on_stop=on_stop, successor=successor).run()
+    print 'end'
+
 
 # paste-deploy server factory
 def server_factory(default, **config):
     """
         paste-deploy server factory
             return a wrapper for waitress:serve
+        options besides those of waitress:
+            workers -> number of worker processes, pre-fork mode if > 1.
+            reuse_port -> pre-fork mode, bind a socket in each worker (SO_REUSEPORT).
+                          disabled if workers are recycled.
+            unix_socket -> listen on unix socket of this path instead of host:port.
+            unix_socket_perms -> permissions of unix socket file (octal).
+            shutdown_timeout -> seconds to wait for active requests on SIGTERM.
+            threads_min, threads_max -> bounds of adaptive thread pool,
+                                        fixed number of threads if threads_max is not set.
+            threads_wait_ms -> pool grows if mean queue wait exceeds this.
+            threads_interval -> seconds between adjustments of pool.
+            max_requests -> a worker is replaced after this many requests.
+            max_requests_jitter -> random 0 - jitter added to max_requests of each worker.
+            max_rss_mb -> a worker is replaced once its resident memory exceeds this.
     """
     config = from_paste_config(config)
+    workers = int(config.pop('workers', 1))
+    reuse_port = asbool(config.pop('reuse_port', False))
+
+    unix_socket = config.pop('unix_socket', None)
+    if unix_socket:
+        config.pop('host', None)
+        config.pop('port', None)
+        config['unix_socket'] = unix_socket
+        config['unix_socket_perms'] = int(str(config.pop('unix_socket_perms', '600')), 8)
+        # removed with pid file by daemon, see Daemon.del_pid_file
+        register_socket_file(unix_socket)
+
+    # recycled workers are replaced by master, so master runs even for one worker.
+    recycling = config.get('max_requests') or config.get('max_rss_mb')
+    if recycling and reuse_port:
+        # connections queued on socket of a recycled worker would be reset,
+        # workers share the socket of master instead.
+        print 'reuse_port is disabled, as workers are recycled (max_requests, max_rss_mb)'
+        reuse_port = False
 
     def serve_forever(application):
-        global signal_context
-        with signal_context:
-            try:
-                serve(application, **config)
-            except (Termination, KeyboardInterrupt) as e:
-                print 'end'
+        if workers > 1 or recycling:
+            serve_prefork(application, workers, reuse_port=reuse_port, **config)
+        else:
+            serve_waitress(application, **config)
 
     return serve_forever
 
@@ -50,8 +414,16 @@ def server_factory_dbg(default, **config):
     host = config.pop('host', '0.0.0.0')
     port = config.pop('port', 8020)
 
+    @threaded(name='config_reloader', daemon=True)
+    def reload_forever():
+        # run_simple has no loop of ours to reload config in.
+        while True:
+            time.sleep(1)
+            reload_if_requested()
+
     def serve_forever(application):
         global signal_context
+        reload_forever()
         with signal_context:
             try:
                 run_simple(host, port, application, **config)
@@ -59,3 +431,159 @@ def server_factory_dbg(default, **config):
                 print 'end'
 
     return serve_forever
+
+
+
+if eventlet is not None:
+    class DrainingHttpProtocol(eventlet.wsgi.HttpProtocol):
+        """
+            marks connection busy from its request line on, so graceful exit
+            of eventlet.wsgi.server shuts down idle connections only.
+            (eventlet does not set STATE_REQUEST itself, every connection
+            would be shut down, with requests in progress)
+        """
+        def handle_one_request(self):
+            if self.conn_state[2] != eventlet.wsgi.STATE_CLOSE:
+                self.conn_state[2] = eventlet.wsgi.STATE_IDLE
+            return eventlet.wsgi.HttpProtocol.handle_one_request(self)
+
+        def _read_request_line(self):
+            line = eventlet.wsgi.HttpProtocol._read_request_line(self)
+            if line and self.conn_state[2] == eventlet.wsgi.STATE_IDLE:
+                self.conn_state[2] = eventlet.wsgi.STATE_REQUEST
+            return line
+
+
+def serve_eventlet(application, host='0.0.0.0', port=8020, backlog=1024,
+                   shutdown_timeout=30, **config):
+    """
+        run application in eventlet wsgi server (a green thread per request).
+        on SIGTERM, stops accepting, closes idle connections and waits
+        for active requests up to shutdown_timeout seconds.
+        on SIGUSR2, starts a successor on the listening socket (see GracefulServer),
+        and drains as above once it serves.
+    """
+    # fresh hub in serving process, the one created while loading app
+    # (e.g. by monkey_patch_for) has its epoll fd closed by daemonizing.
+    eventlet.hubs.use_hub()
+
+    sockets = inherited_sockets()
+    if sockets:
+        # started by reload, serve on socket of predecessor.
+        sock = eventlet.greenio.GreenSocket(sockets[0])
+    else:
+        sock = eventlet.listen((host, port), backlog=backlog)
+    config.setdefault('protocol', DrainingHttpProtocol)
+    server = eventlet.spawn(eventlet.wsgi.server, sock, application, **config)
+
+    state = {'stopping': False, 'reloading': False, 'handoff': None}
+    def stop(sig, stack):
+        state['stopping'] = True
+
+    def reload_server(sig, stack):
+        state['reloading'] = True
+
+    def check_handoff():
+        if state['reloading']:
+            state['reloading'] = False
+            if state['handoff'] is None:
+                state['handoff'] = start_successor([sock])
+
+        handoff = state['handoff']
+        if handoff is None:
+            return
+
+        ready = handoff.poll()
+        if ready:
+            print 'successor (pid %d) is ready, stopping' % handoff.pid
+            state['stopping'] = True
+        elif ready is not None:
+            print 'successor (pid %d) failed, keep running' % handoff.pid
+            state['handoff'] = None
+
+    context = SignalContext({
+        signal.SIGTERM: stop,
+        signal.SIGHUP: reload,
+        signal.SIGUSR2: reload_server,
+    })
+
+    print 'Serving on http://%s:%s (eventlet)' % sock.getsockname()[:2]
+    with context:
+        notify_ready()
+        try:
+            while not state['stopping'] and not server.dead:
+                eventlet.sleep(0.5 if state['handoff'] is None else 0.1)
+                reload_if_requested()
+                if state['reloading'] or state['handoff'] is not None:
+                    check_handoff()
+        except KeyboardInterrupt as e:
+            server.kill()
+            return
+
+        started = time.time()
+        print 'draining, timeout %ss' % shutdown_timeout
+        # GreenletExit in accept loop, wsgi.server then closes
+        # idle connections and waits for active requests.
+        server.kill()
+        sock.close()
+        with eventlet.Timeout(shutdown_timeout, False):
+            try:
+                server.wait()
+            except greenlet.GreenletExit as e:
+                pass
+        elapsed = time.time() - started
+        if server.dead:
+            print 'drained in %.3fs' % elapsed
+        else:
+            print 'drain timed out after %.3fs' % elapsed
+
+
+def monkey_patch_for(factory, config):
+    """
+        patch standard library if factory is server_factory_eventlet
+        with monkey_patch enabled.
+        should be called before app is loaded, locks and threads
+        created earlier stay real ones, and block the whole server.
+        output:
+            bool -> if patched.
+    """
+    if factory is not server_factory_eventlet or eventlet is None:
+        return False
+    if not asbool(config.get('monkey_patch', True)):
+        return False
+
+    eventlet.monkey_patch()
+    return True
+
+
+def server_factory_eventlet(default, **config):
+    """
+        paste-deploy server factory
+            return a wrapper for eventlet.wsgi:server
+        blocking I/O (sockets, time.sleep, threads) of views yields to
+        other requests once standard library is monkey patched,
+        so concurrency of I/O bound views is not bound to a thread count.
+        options:
+            monkey_patch -> patch standard library (default: true)
+                            kapp_manage patches before loading app (see monkey_patch_for),
+                            patching here is too late for locks created by app.
+            shutdown_timeout -> seconds to wait for active requests on SIGTERM.
+            backlog -> listen backlog.
+            others are passed to eventlet.wsgi:server
+                (e.g. max_size, keepalive, socket_timeout, log_output)
+    """
+    if eventlet is None:
+        raise ImportError('eventlet is required by server_factory_eventlet')
+
+    config = from_paste_config(config)
+    if asbool(config.pop('monkey_patch', True)):
+        eventlet.monkey_patch()
+
+    # do not send tracebacks to clients
+    config.setdefault('debug', False)
+
+    def serve_forever(application):
+        serve_eventlet(application, **config)
+        print 'end'
+
+    return serve_forever
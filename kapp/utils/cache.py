@@ -9,6 +9,7 @@
 
 from time import time
 from copy import deepcopy, copy
+from collections import OrderedDict
 # from threading import Lock
 from threading import local
 import warnings
@@ -162,6 +163,99 @@ class SimpleCache(object):
     # del _threadsafe
 
 
+class LRUCache(object):
+    """
+        A bounded in-memory key-value store.
+        least recently used records are evicted when full,
+        records older than `ttl` seconds are treated as missing.
+        APIs:
+            get, set, pop, clear
+            APIs are thread-safe.
+    """
+
+    def __init__(self, maxsize=128, ttl=None):
+        """
+            input:
+                maxsize
+                    max number of records kept.
+                ttl:
+                    a decimal
+                    seconds a record stays valid.
+                    if None, records never expire.
+        """
+        assert maxsize > 0
+        self.maxsize = int(maxsize)
+        self.ttl = ttl
+        self.cache = OrderedDict()
+
+    ##################
+    # APIs
+    ##################
+
+    @mthread_safe
+    def get(self, key, default=None):
+        """
+            get cached value of key,
+            `default` if key is missing or outdated.
+        """
+        try:
+            value, deadline = self.cache.pop(key)
+        except KeyError:
+            return default
+
+        if deadline is not None and time() >= deadline:
+            return default
+
+        # re-insert as most recently used.
+        self.cache[key] = (value, deadline)
+        return value
+
+    @mthread_safe
+    def set(self, key, value):
+        self.cache.pop(key, None)
+        deadline = time() + self.ttl if self.ttl else None
+        self.cache[key] = (value, deadline)
+
+        while len(self.cache) > self.maxsize:
+            self.cache.popitem(last=False)
+
+    @mthread_safe
+    def pop(self, key, default=None):
+        value, deadline = self.cache.pop(key, (default, None))
+        if deadline is not None and time() >= deadline:
+            return default
+        return value
+
+    @mthread_safe
+    def clear(self):
+        self.cache.clear()
+
+    @mthread_safe
+    def __len__(self):
+        """
+            number of valid records, outdated ones are removed first.
+        """
+        if self.ttl:
+            now = time()
+            outdated = [key for key, (value, deadline) in self.cache.iteritems()
+                        if deadline is not None and now >= deadline]
+            for key in outdated:
+                del self.cache[key]
+        return len(self.cache)
+
+    @mthread_safe
+    def __contains__(self, key):
+        """
+            membership test, order of records is not changed.
+        """
+        try:
+            value, deadline = self.cache[key]
+        except KeyError:
+            return False
+        return deadline is None or time() < deadline
+
+
+
 try:
     import cPickle as pickle
 except ImportError, e:
@@ -377,6 +471,27 @@ class SqliteStore(object):
         return self._exclude(exclude_cond=exclude_cond)
 
 
+    @mthread_safe
+    @_maintained
+    def page(self, limit, marker=None, filter_cond=None):
+        """
+            keyset pagination: records after id `marker`, ordered by id.
+            output:
+                [(id, value)]
+        """
+        self._filter_cond = filter_cond
+
+        cursor = self.db.execute(
+            'SELECT id, value FROM %s WHERE id > ? AND check_filter(value) '
+            'ORDER BY id LIMIT ?;' % self.tab_name,
+            (marker or 0, limit)
+        )
+        rows = cursor.fetchall()
+
+        self._filter_cond = None
+        return rows
+
+
     del _maintained
 
 
@@ -392,6 +507,52 @@ class SqliteStore(object):
 
 import unittest
 
+class TestLRUCache(unittest.TestCase):
+    def test_basic(self):
+        cache = LRUCache(maxsize=2)
+
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertEqual(cache.get('a'), 1)
+
+        # 'b' is the least recently used one.
+        cache.set('c', 3)
+        self.assertEqual(len(cache), 2)
+        self.assertTrue('b' not in cache)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        self.assertEqual(cache.pop('a'), 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_ttl(self):
+        import time
+
+        cache = LRUCache(maxsize=2, ttl=0.5)
+        cache.set('a', 1)
+        self.assertEqual(cache.get('a'), 1)
+
+        time.sleep(0.6)
+        self.assertEqual(cache.get('a', 'outdated'), 'outdated')
+
+        cache.set('b', 2)
+        time.sleep(0.6)
+        self.assertTrue('b' not in cache)
+        self.assertEqual(len(cache), 0)
+
+    def test_contains_keeps_order(self):
+        cache = LRUCache(maxsize=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        self.assertTrue('a' in cache)
+
+        # 'a' is still the least recently used one.
+        cache.set('c', 3)
+        self.assertTrue('a' not in cache)
+        self.assertTrue('b' in cache)
+
+
 class TestSqliteStore(unittest.TestCase):
     def test_basic(self):
         cache = SqliteStore()
@@ -500,6 +661,21 @@ class TestSqliteStore(unittest.TestCase):
         fmsgs = cache.exclude()
         self.assertEqual(fmsgs[0], msgs[2])
 
+    def test_page(self):
+        cache = SqliteStore()
+
+        msgs = [{'v': i} for i in range(5)]
+        cache.add(*msgs)
+
+        rows = cache.page(2)
+        self.assertEqual([value for id, value in rows], msgs[:2])
+
+        rows = cache.page(2, marker=rows[-1][0])
+        self.assertEqual([value for id, value in rows], msgs[2:4])
+
+        rows = cache.page(10, filter_cond=lambda msg: msg['v'] % 2 == 0)
+        self.assertEqual([value for id, value in rows], msgs[::2])
+
     def test_basic_auto_outdate(self):
         import time
 
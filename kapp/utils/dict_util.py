@@ -47,3 +47,33 @@ def sub_dict(d, *keys):
             print sd    # {'a': 1}
     """
     return dict((key, d[key]) for key in keys if key in d)
+
+
+class FrozenDict(dict):
+    """
+        read-only (and hashable) dict.
+        usage:
+            fd = FrozenDict({'a': 1})
+            fd['a'] = 2     # TypeError
+            {fd: 'value'}   # usable as dict key, if all values are hashable.
+    """
+    def _readonly(self, *args, **kwargs):
+        raise TypeError('%s is read-only' % type(self).__name__)
+
+    __setitem__ = __delitem__ = _readonly
+    clear = pop = popitem = setdefault = update = _readonly
+
+    def __hash__(self):
+        if not hasattr(self, '_hash'):
+            self._hash = hash(frozenset(self.iteritems()))
+        return self._hash
+
+    def __reduce__(self):
+        return (type(self), (dict(self),))
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        from copy import deepcopy
+        return type(self)(deepcopy(dict(self), memo))
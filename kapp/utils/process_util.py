@@ -1,18 +1,28 @@
 # -*- coding:utf-8 -*-
 
 import os, sys
+import stat
+import time
 import signal
+import socket
+import select
+import atexit
+import traceback
 
 import resource
+import fcntl
 import errno
 
 
-def close_all_files():
+def close_all_files(exclude=()):
     maxfd = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
     if maxfd == resource.RLIM_INFINITY:
         maxfd = 1024
 
+    exclude = frozenset(exclude)
     for fd in xrange(maxfd):
+        if fd in exclude:
+            continue
         try:
             os.close(fd)
         except OSError as e:
@@ -90,6 +100,53 @@ class SignalContext(object):
         self.deactivate()
 
 
+# unix socket files of servers, removed with pid file.
+_socket_files = set()
+
+
+def register_socket_file(path):
+    _socket_files.add(os.path.abspath(path))
+
+
+def unix_socket_alive(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(1)
+    try:
+        sock.connect(path)
+    except socket.error as e:
+        return False
+    finally:
+        sock.close()
+    return True
+
+
+def remove_stale_socket(path):
+    """
+        remove unix socket file left by a killed server.
+        output:
+            bool -> if removed.
+    """
+    if not os.path.exists(path):
+        return False
+    if not stat.S_ISSOCK(os.stat(path).st_mode):
+        raise RuntimeError('%s exists and is not a socket' % path)
+    if unix_socket_alive(path):
+        raise RuntimeError('%s is in use by another server' % path)
+    os.remove(path)
+    return True
+
+
+def cleanup_socket_files():
+    for path in list(_socket_files):
+        remove_stale_socket(path)
+
+
+def remove_socket_files():
+    for path in list(_socket_files):
+        if os.path.exists(path):
+            os.remove(path)
+
+
 class Daemon(object):
     def __init__(self, pidfile, func=None, args=(), kwargs={}, stdin=os.devnull, stdout=os.devnull, stderr=os.devnull):
         self.pidfn = pidfile
@@ -125,9 +182,16 @@ class Daemon(object):
             f.write(str(value))
 
 
+    def adopt(self):
+        # take over pid file from predecessor (reload by Handoff).
+        self.pid = os.getpid()
+
     def del_pid_file(self):
-        if os.path.exists(self.pidfn):
+        # only the process written in pid file owns it and socket files,
+        # forked workers, or predecessor of reload, must not remove them.
+        if self.pid == os.getpid():
             os.remove(self.pidfn)
+            remove_socket_files()
 
     def run(self, *args, **kwargs):
         assert callable(self.func), 'invalid function'
@@ -136,6 +200,10 @@ class Daemon(object):
         return self.func(*self.args, **self.kwargs)
 
     def start(self, *args, **kwargs):
+        if self.pid is None:
+            # socket files left by a killed daemon.
+            cleanup_socket_files()
+
         pid = os.fork()
         assert pid >= 0, 'failed to call fork'
 
@@ -179,10 +247,380 @@ class Daemon(object):
         return self.pid is not None
 
     def cleanup(self):
-        assert not self.running(), 'daemon is running.'
-        self.del_pid_file()
+        # remove pid file left by a killed daemon.
+        assert not self.running or not pid_alive(self.pid), 'daemon is running.'
+        if os.path.exists(self.pidfn):
+            os.remove(self.pidfn)
+        cleanup_socket_files()
+
 
 
+_page_size = resource.getpagesize()
+
+def get_rss():
+    """
+        output:
+            int -> resident set size (bytes) of this process, None if unknown.
+    """
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * _page_size
+    except (IOError, IndexError, ValueError) as e:
+        return None
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+LISTEN_FDS_ENV = 'KAPP_LISTEN_FDS'
+READY_FD_ENV = 'KAPP_READY_FD'
+
+_ready_callbacks = []
+
+
+def set_cloexec(fd, cloexec=True):
+    flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+    if cloexec:
+        flags |= fcntl.FD_CLOEXEC
+    else:
+        flags &= ~fcntl.FD_CLOEXEC
+    fcntl.fcntl(fd, fcntl.F_SETFD, flags)
+
+
+class Handoff(object):
+    """
+        start a successor process inheriting listening sockets,
+        so a new version is loaded without closing the port.
+        usage:
+            # old process
+            handoff = Handoff(['/usr/bin/python', '/usr/bin/kapp_manage', 'run'], [sock]).start()
+            while handoff.poll(timeout=0.1) is None:
+                serve_some()
+            # True: successor is serving, stop accepting, drain and exit.
+
+            # successor
+            sockets = inherited_sockets()   # [] if not started by Handoff
+            ...                             # serve on sockets
+            notify_ready()
+    """
+    def __init__(self, argv, sockets=()):
+        self.argv = list(argv)
+        self.sockets = list(sockets)
+        self.pid = None
+        self.ready_fd = None
+        self.result = None
+
+    def start(self):
+        r, w = os.pipe()
+        set_cloexec(r)
+
+        env = dict(os.environ)
+        env[LISTEN_FDS_ENV] = ','.join('%d:%d' % (s.fileno(), s.family) for s in self.sockets)
+        env[READY_FD_ENV] = str(w)
+        keep = [0, 1, 2, w] + [s.fileno() for s in self.sockets]
+
+        pid = os.fork()
+        assert pid >= 0, 'failed to call fork'
+        if pid == 0:
+            try:
+                close_all_files(exclude=keep)
+                for fd in keep:
+                    set_cloexec(fd, False)
+                os.execve(self.argv[0], self.argv, env)
+            finally:
+                os._exit(127)
+
+        os.close(w)
+        self.pid, self.ready_fd = pid, r
+        return self
+
+    def poll(self, timeout=0):
+        """
+            output:
+                None -> successor is starting.
+                True -> successor is ready.
+                False -> successor exited before it is ready.
+        """
+        if self.result is not None:
+            return self.result
+
+        try:
+            readable = select.select([self.ready_fd], [], [], timeout)[0]
+        except select.error as e:
+            if e.args[0] == errno.EINTR:
+                return None
+            raise
+        if not readable:
+            return None
+
+        data = os.read(self.ready_fd, 1)
+        os.close(self.ready_fd)
+        self.result = bool(data)
+        if not self.result:
+            try:
+                os.waitpid(self.pid, 0)
+            except OSError as e:
+                # reaped by a master waiting for its workers.
+                if e.errno != errno.ECHILD:
+                    raise
+        return self.result
+
+
+def inherited_sockets():
+    """
+        output:
+            [socket] -> listening sockets passed by Handoff, [] if none.
+    """
+    value = os.environ.pop(LISTEN_FDS_ENV, '')
+    sockets = []
+    for item in value.split(','):
+        if not item:
+            continue
+        fd, family = [int(v) for v in item.split(':')]
+        # fromfd duplicates fd, and returns a _socket.socket
+        # which is not accepted as socket.socket by waitress.
+        sock = socket.fromfd(fd, family, socket.SOCK_STREAM)
+        sockets.append(socket.socket(family, socket.SOCK_STREAM, _sock=sock))
+        os.close(fd)
+    return sockets
+
+
+def is_successor():
+    return READY_FD_ENV in os.environ
+
+
+def on_ready(callback):
+    """
+        register a callback run by notify_ready, before predecessor is told.
+        (e.g. to take over pid file)
+    """
+    _ready_callbacks.append(callback)
+    return callback
+
+
+def notify_ready():
+    """
+        tell predecessor this process is serving, so it can exit.
+        output:
+            bool -> False if not started by Handoff.
+    """
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd is None:
+        return False
+
+    for callback in _ready_callbacks:
+        callback()
+
+    fd = int(fd)
+    os.write(fd, '1')
+    os.close(fd)
+    return True
+
+
+class Prefork(object):
+    """
+        master of forked worker processes.
+        usage:
+            sock = make_listen_socket(...)   # opened before fork, shared by workers
+
+            def worker(no):
+                serve(app, sockets=[sock])
+
+            Prefork(worker, workers=4).run()
+
+        master process:
+            forks workers, respawns workers which exit unexpectedly.
+            SIGTERM, SIGINT -> forwarded to workers, waits for them
+                               shutdown_timeout seconds, kills the rest.
+            forward_signals -> forwarded to workers. (e.g. SIGHUP to reload config)
+            on_stop -> called before workers are stopped. (e.g. to close master copy of shared socket)
+            successor -> called on SIGUSR2 to start a Handoff, master stops
+                         its workers once successor is ready.
+        worker process:
+            runs func(no, *args, **kwargs) and exits by os._exit,
+            never returns to code of master (e.g. finally clause of Daemon.start).
+    """
+    def __init__(self, func, workers=2, args=(), kwargs={},
+                 shutdown_timeout=10, respawn_delay=1, forward_signals=(signal.SIGHUP,),
+                 on_stop=None, successor=None):
+        self.func = func
+        self.workers = workers
+        self.args = list(args)
+        self.kwargs = kwargs
+        self.shutdown_timeout = shutdown_timeout
+        self.respawn_delay = respawn_delay
+        self.forward_signals = tuple(forward_signals)
+        self.on_stop = on_stop
+        self.successor = successor
+
+        self.children = {}  # pid -> (worker no, started at)
+        self.stopping = False
+        self.reloading = False
+        self.handoff = None
+
+        actions = {
+            signal.SIGTERM: self._on_stop,
+            signal.SIGINT: self._on_stop,
+        }
+        for signum in self.forward_signals:
+            actions[signum] = self._on_forward
+        if self.successor is not None:
+            actions[signal.SIGUSR2] = self._on_reload
+        self.signal_context = SignalContext(actions)
+
+    def _on_stop(self, signum, frame):
+        self.stopping = True
+
+    def _on_reload(self, signum, frame):
+        self.reloading = True
+
+    def _on_forward(self, signum, frame):
+        self.kill_workers(signum)
+
+    def kill_workers(self, signum):
+        for pid in self.children.keys():
+            try:
+                os.kill(pid, signum)
+            except OSError as e:
+                if e.errno != errno.ESRCH:
+                    raise
+
+    def _worker_main(self, no):
+        # signals of master are ignored until worker sets up its own handlers,
+        # a forwarded SIGHUP or a SIGINT of terminal (master stops workers
+        # by SIGTERM then) does not kill it in the meantime.
+        # SIGTERM is restored to default, nothing to drain yet.
+        for signum in self.signal_context.sig_actions.iterkeys():
+            if signum == signal.SIGTERM:
+                signal.signal(signum, signal.SIG_DFL)
+            else:
+                signal.signal(signum, signal.SIG_IGN)
+        # exit functions inherited from master are not ours.
+        del atexit._exithandlers[:]
+        # only master tells predecessor it is ready.
+        os.environ.pop(READY_FD_ENV, None)
+
+        code = 0
+        try:
+            self.func(no, *self.args, **self.kwargs)
+        except SystemExit as e:
+            code = e.code if isinstance(e.code, int) else 1
+        except BaseException as e:
+            traceback.print_exc()
+            code = 1
+        finally:
+            try:
+                atexit._run_exitfuncs()
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(code)
+
+    def spawn(self, no):
+        pid = os.fork()
+        assert pid >= 0, 'failed to call fork'
+        if pid == 0:
+            self._worker_main(no)
+
+        self.children[pid] = (no, time.time())
+        return pid
+
+    def _wait(self, pid=-1, options=0):
+        """
+            output:
+                (pid, status) -> pid is 0 if no child exited (os.WNOHANG)
+                None -> interrupted by signal.
+        """
+        try:
+            return os.waitpid(pid, options)
+        except OSError as e:
+            if e.errno == errno.EINTR:
+                return None
+            if e.errno == errno.ECHILD:
+                # already reaped
+                return pid, 0
+            raise
+
+    def _check_handoff(self):
+        if self.reloading:
+            self.reloading = False
+            if self.handoff is None:
+                self.handoff = self.successor()
+            if self.handoff is None:
+                return
+
+        ready = self.handoff.poll(timeout=0.1)
+        if ready:
+            print 'successor (pid %d) is ready, stopping' % self.handoff.pid
+            self.stopping = True
+        elif ready is not None:
+            print 'successor (pid %d) failed, keep running' % self.handoff.pid
+            self.handoff = None
+
+    def run(self):
+        with self.signal_context:
+            for no in xrange(self.workers):
+                self.spawn(no)
+            notify_ready()
+
+            while not self.stopping:
+                if self.reloading or self.handoff is not None:
+                    self._check_handoff()
+                    if self.stopping:
+                        break
+                    exited = self._wait(-1, os.WNOHANG)
+                else:
+                    exited = self._wait()
+
+                if exited is None or exited[0] not in self.children:
+                    continue
+
+                pid, status = exited
+                no, started = self.children.pop(pid)
+                if self.stopping:
+                    break
+
+                print 'worker %d (pid %d) exited, status %d, respawning' % (no, pid, status)
+                if time.time() - started < self.respawn_delay:
+                    # worker fails at startup, do not fork in a busy loop.
+                    time.sleep(self.respawn_delay)
+                if not self.stopping:
+                    self.spawn(no)
+
+            self.shutdown()
+
+    def shutdown(self):
+        if self.on_stop is not None:
+            self.on_stop()
+        self.kill_workers(signal.SIGTERM)
+
+        deadline = time.time() + self.shutdown_timeout
+        while self.children and time.time() < deadline:
+            exited = self._wait(-1, os.WNOHANG)
+            if exited is None:
+                continue
+            if exited[0] == 0:
+                time.sleep(0.05)
+                continue
+            if exited[0] == -1:
+                # no child left
+                self.children.clear()
+                break
+            self.children.pop(exited[0], None)
+
+        if self.children:
+            print 'killing %d worker(s) after %ss' % (len(self.children), self.shutdown_timeout)
+            self.kill_workers(signal.SIGKILL)
+            for pid in self.children.keys():
+                while self._wait(pid) is None:
+                    pass
+            self.children.clear()
+
 
 def daemonized(pidfile, **options):
     """
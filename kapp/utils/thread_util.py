@@ -1,5 +1,6 @@
 # -*- coding:utf-8 -*-
 
+import sys
 import threading, time
 
 def threaded(**options):
@@ -9,6 +10,11 @@ def threaded(**options):
             name -> default : decorated function name
             daemon -> default : False
             start -> default : True
+            green -> default : False
+                     if standard library is monkey patched by eventlet,
+                     start an eventlet green thread (GreenThread) instead,
+                     which does not switch to other green threads on start.
+                     (e.g. threads started while holding a lock created before patching)
         Example:
             @threaded(name='test_function', start=False, daemon=True)
             def test():
@@ -22,10 +28,14 @@ def threaded(**options):
         name = options.get('name', func.__name__)
         daemon = bool(options.get('daemon', False))
         start = bool(options.get('start', True))
+        green = bool(options.get('green', False))
 
         assert callable(func)
 
         def thread_gen(*args, **kwargs):
+            if green and start and green_threads():
+                import eventlet
+                return eventlet.spawn(func, *args, **kwargs)
 
             t = threading.Thread(
                 target=func, 
@@ -44,6 +54,24 @@ def threaded(**options):
     return decorator
 
 
+def green_threads():
+    """
+        output:
+            bool -> if threads are green threads (monkey patched by eventlet).
+    """
+    patcher = getattr(sys.modules.get('eventlet'), 'patcher', None)
+    return patcher is not None and patcher.is_monkey_patched('thread')
+
+
+def thread_alive(t):
+    """
+        is_alive of threading.Thread or eventlet GreenThread.
+    """
+    if hasattr(t, 'is_alive'):
+        return t.is_alive()
+    return not t.dead
+
+
 def make_thread(target, **options):
     return threaded(**options)(target)
 
@@ -63,6 +91,46 @@ def wait_threads(tasks, timeout=5):
     return False
 
 
+def run_parallel(funcs, timeout=None):
+    """
+        call funcs concurrently, a thread for each.
+        threads are green threads in eventlet server (monkey patched),
+        e.g. for views calling several backend services.
+        input:
+            funcs -> [callable], e.g. functools.partial(requests.get, url)
+        output:
+            [result] -> in order of funcs,
+                        exception of the first failed func is raised.
+        Example:
+            users, projects = run_parallel([list_users, list_projects], timeout=10)
+    """
+    results = [None] * len(funcs)
+    errors = [None] * len(funcs)
+
+    def call(i, func):
+        try:
+            results[i] = func()
+        except BaseException as e:
+            errors[i] = sys.exc_info()
+
+    tasks = [make_thread(call, name='parallel', daemon=True)(i, func)
+             for i, func in enumerate(funcs)]
+
+    deadline = None if timeout is None else time.time() + timeout
+    for t in tasks:
+        t.join(None if deadline is None else max(0, deadline - time.time()))
+
+    unfinished = len(filter(lambda t: t.is_alive(), tasks))
+    if unfinished:
+        raise RuntimeError('%d of %d calls not finished in %ss' % (unfinished, len(tasks), timeout))
+
+    for error in errors:
+        if error is not None:
+            raise error[0], error[1], error[2]
+
+    return results
+
+
 # thread safe decorator for function
 def thread_safe(func):
 
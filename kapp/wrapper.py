@@ -5,16 +5,240 @@
 """
 
 import json, types
-from flask import make_response
+import warnings
+import importlib
+from functools import wraps
+from flask import make_response, Response, request, _request_ctx_stack
+from flask import stream_with_context, has_request_context
+from werkzeug.exceptions import HTTPException
 
-def json_response(data, status=200, headers={}):
+from .utils.cache import LRUCache
+
+try:
+    import ujson
+except ImportError, e:
+    ujson = None
+
+try:
+    import simplejson
+except ImportError, e:
+    simplejson = None
+
+try:
+    import msgpack
+except ImportError, e:
+    msgpack = None
+else:
+    if msgpack.Packer.__module__ == 'msgpack.fallback':
+        warnings.warn('msgpack C extension is not available, '
+                      'msgpack responses are slower than json.')
+
+
+# available json encoders: name -> dumps(obj) -> str
+json_encoders = {'json': json.dumps}
+if simplejson is not None:
+    json_encoders['simplejson'] = simplejson.dumps
+if ujson is not None:
+    json_encoders['ujson'] = ujson.dumps
+
+# standard json by default, others are opt-in (JSON_ENCODER),
+# output differs: ujson truncates floats, encodes unknown objects as {}
+# and escapes '/'.
+_json_dumps = json.dumps
+
+
+def set_json_encoder(encoder):
+    """
+        choose encoder used by json_response.
+        input:
+            encoder -> name in json_encoders, or a callable like json.dumps
+    """
+    global _json_dumps
+    if not callable(encoder):
+        if encoder not in json_encoders:
+            warnings.warn('json encoder %s is not installed.' % encoder)
+            return
+        encoder = json_encoders[encoder]
+    _json_dumps = encoder
+
+
+def dumps_json(data):
+    """
+        encode data (dict or anything dict() accepts) with current encoder.
+        dict is encoded as is, without copy.
+    """
+    if not isinstance(data, dict):
+        data = dict(data)
+    return _json_dumps(data)
+
+
+def json_response(data, status=200, headers={}, etag=None):
+    """
+        input:
+            etag ->
+                True: ETag is a hash of the body.
+                str: ETag given by view (e.g. version of data).
+                If-None-Match of request is answered with 304.
+    """
     status = int(status)
     __headers = {'Content-Type': 'application/json'}
     __headers.update(headers)
 
     if not isinstance(data, types.StringTypes):
-        data = json.dumps(dict(data))
-    return make_response(data, status, __headers)
+        data = dumps_json(data)
+    response = make_response(data, status, __headers)
+    if etag:
+        set_etag(response, etag)
+    return response
+
+
+MSGPACK_MIMETYPES = ('application/msgpack', 'application/x-msgpack')
+
+
+def dumps_msgpack(data):
+    """
+        encode data (dict or anything dict() accepts) into msgpack.
+    """
+    if not isinstance(data, dict):
+        data = dict(data)
+    # str and unicode are both packed as (utf-8) string type.
+    return msgpack.packb(data, use_bin_type=False)
+
+
+def negotiate_format():
+    """
+        output:
+            'msgpack' -> client prefers msgpack (and msgpack is installed)
+            'json' -> otherwise.
+    """
+    if msgpack is None or not has_request_context():
+        return 'json'
+    best = request.accept_mimetypes.best_match(
+        ('application/json',) + MSGPACK_MIMETYPES, 'application/json')
+    return 'msgpack' if best in MSGPACK_MIMETYPES else 'json'
+
+
+def data_response(data, status=200, headers={}, etag=None):
+    """
+        json_response with content negotiation:
+            msgpack if request has "Accept: application/msgpack",
+            json otherwise.
+    """
+    if isinstance(data, types.StringTypes) or negotiate_format() == 'json':
+        response = json_response(data, status, headers, etag)
+    else:
+        __headers = {'Content-Type': MSGPACK_MIMETYPES[0]}
+        __headers.update(headers)
+        response = make_response(dumps_msgpack(data), int(status), __headers)
+        if etag:
+            set_etag(response, etag)
+
+    if msgpack is not None:
+        response.vary.add('Accept')
+    return response
+
+
+def set_etag(response, etag=True):
+    """
+        set ETag of response, and turn it into 304 (without body)
+        if it matches If-None-Match of current request.
+        input:
+            etag -> True to hash the body, or str
+    """
+    if etag is True:
+        if response.is_streamed or response.status_code != 200:
+            return response
+        response.add_etag()
+    else:
+        response.set_etag(str(etag))
+
+    if has_request_context():
+        response.make_conditional(request)
+    return response
+
+
+def etag_view(f, etag=True):
+    """
+        add ETag to responses of view f, answer If-None-Match with 304.
+        input:
+            etag ->
+                True: ETag is a hash of the response body.
+                callable: etag(**view_args) -> str, version of data,
+                          view is not called at all if it matches If-None-Match.
+                str: fixed version, as returned by a callable.
+    """
+    if not (etag is True or callable(etag)):
+        version = str(etag)
+        etag = lambda **view_args: version
+
+    @wraps(f)
+    def view(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return f(*args, **kwargs)
+
+        if etag is True:
+            return set_etag(make_response(f(*args, **kwargs)))
+
+        version = str(etag(**kwargs))
+        if request.if_none_match.contains_weak(version):
+            response = empty_json_response(304)
+            response.set_etag(version)
+            return response
+
+        return set_etag(make_response(f(*args, **kwargs)), version)
+
+    return view
+
+
+def stream_json_response(items, key=None, status=200, headers={}, chunk_size=8192):
+    """
+        stream a json array, items are encoded one by one,
+        memory usage does not grow with number of items.
+        input:
+            items -> iterable (generator) of json-serializable items.
+            key -> if given, array is wrapped as {key: [...]}
+            chunk_size -> bytes buffered before sending a chunk.
+        usage:
+            @lazy_app.route(r'/users', methods=['GET'])
+            def list_users():
+                return stream_json_response(iter_users(), key='users')
+        note:
+            status and headers are sent with the first chunk,
+            an exception raised by items afterwards truncates the response.
+    """
+    status = int(status)
+    __headers = {'Content-Type': 'application/json'}
+    __headers.update(headers)
+
+    dumps = _json_dumps
+
+    def generate():
+        if key is None:
+            head, tail = '[', ']'
+        else:
+            head, tail = '{%s:[' % dumps(key), ']}'
+
+        buf = [head]
+        size = len(head)
+        sep = ''
+        for item in items:
+            chunk = sep + dumps(item)
+            sep = ','
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= chunk_size:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+
+        buf.append(tail)
+        yield ''.join(buf)
+
+    body = generate()
+    if has_request_context():
+        # items may need request context (e.g. creds) while streaming.
+        body = stream_with_context(body)
+    return Response(body, status, __headers)
 
 
 def empty_json_response(status=204, headers={}):
@@ -24,6 +248,166 @@ def empty_json_response(status=204, headers={}):
     return make_response('', status, __headers)
 
 
+def _creds_field(creds, field):
+    """
+        value of dotted field in creds, e.g. 'project.id', 'roles'
+        for a dict value (e.g. 'project'), its 'id' is used.
+    """
+    value = creds
+    for key in field.split('.'):
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+
+    if isinstance(value, dict):
+        value = value.get('id')
+    elif isinstance(value, list):
+        value = tuple(sorted(value))
+    return value
+
+
+def cached_view(f, ttl, vary_on=(), maxsize=256):
+    """
+        cache full responses of GET (HEAD) view f.
+        input:
+            ttl -> seconds a response is cached.
+            vary_on -> credential fields in cache key, e.g. ('project', 'user.id')
+                       responses are not cached if request has no creds.
+            maxsize -> max number of cached responses.
+        only 200 responses without cookies or "no-store" are cached,
+        key is (path, query string, Accept header, values of vary_on).
+    """
+    cache = LRUCache(maxsize, ttl)
+
+    @wraps(f)
+    def view(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return f(*args, **kwargs)
+
+        varies = ()
+        if vary_on:
+            creds = getattr(_request_ctx_stack.top, 'creds', None)
+            if creds is None:
+                # tenants can not be told apart.
+                return f(*args, **kwargs)
+            varies = tuple(_creds_field(creds, field) for field in vary_on)
+
+        # Accept: view may negotiate response format (data_response)
+        key = (request.path, request.query_string,
+               request.environ.get('HTTP_ACCEPT'), varies)
+        cached = cache.get(key)
+        if cached is None:
+            response = make_response(f(*args, **kwargs))
+            if response.status_code != 200 or response.is_streamed or \
+               'Set-Cookie' in response.headers or \
+               'no-store' in response.headers.get('Cache-Control', ''):
+                return response
+
+            cache.set(key, (response.get_data(), response.headers.to_wsgi_list()))
+            return response
+
+        body, headers = cached
+        response = Response(body, 200, headers)
+        if 'ETag' in response.headers:
+            response.make_conditional(request)
+        return response
+
+    return view
+
+
+# canned error responses: code -> (title, message)
+ERRORS = {
+    403: ('Forbidden', 'policy checking failed'),
+    404: ('Not Found', 'resource not found'),
+    429: ('Too Many Requests', 'too many requests'),
+    503: ('Service Unavailable', 'service unavailable'),
+}
+
+
+class ErrorResponses(object):
+    """
+        json error responses, serialized once.
+        usage:
+            errors = ErrorResponses()
+            return errors.response(403)
+    """
+    def __init__(self, errors=ERRORS):
+        self.responses = {}
+        for code, (title, message) in errors.iteritems():
+            body = json.dumps({
+                'error': {
+                    'message': message,
+                    'code': code,
+                    'title': title
+                }
+            })
+            headers = (
+                ('Content-Type', 'application/json'),
+                ('Content-Length', str(len(body)))
+            )
+            self.responses[code] = (body, headers)
+
+    def response(self, code):
+        body, headers = self.responses[code]
+        return Response(body, code, headers)
+
+
+def init_error_responses(app):
+    """
+        input:
+            app -> flask app
+
+        output:
+            app.error_responses
+            404, 429, 503 are answered with canned json errors,
+            unless raised with a description, headers (e.g. Retry-After)
+            or a response of their own, which are then kept.
+    """
+    errors = ErrorResponses()
+    app.error_responses = errors
+
+    def canned_error(e):
+        if e.response is not None or \
+           e.description != type(e).description or \
+           e.get_headers() != HTTPException.get_headers(e):
+            return e
+        return errors.response(e.code)
+
+    for code in (404, 429, 503):
+        app.register_error_handler(code, canned_error)
+
+    return errors
+
+
+class LazyView(object):
+    """
+        placeholder of a view registered from a route manifest,
+        module of the real view is imported on first request.
+    """
+    def __init__(self, urls, record):
+        self.urls = urls
+        self.rule = record['rule']
+        self.endpoint = record['endpoint']
+        self.module = record['module']
+        self.view = None
+
+        self.__name__ = self.endpoint
+        if record.get('policy_rule') is not None:
+            self.policy_rule = record['policy_rule']
+
+    def load(self):
+        if self.view is None:
+            importlib.import_module(self.module)
+            view = self.urls.find_view(self.rule, self.endpoint)
+            assert view is not None, \
+                'route %s (%s) is not in %s' % (self.rule, self.endpoint, self.module)
+            self.view = view
+        return self.view
+
+    def __call__(self, *args, **kwargs):
+        return self.load()(*args, **kwargs)
+
+
 class UrlRuleCache(object):
     """
         use this class to cache views for flask (app, blueprint)
@@ -40,6 +424,24 @@ class UrlRuleCache(object):
             def index():
                 return 'index'
 
+            # protected by policy rule 'kapp:index', instead of 'kapp:all'
+            @lazy_urls.route(r'/admin', methods=['GET'], policy_rule='kapp:index')
+            def admin():
+                return 'admin'
+
+            # ETag: hash of response body (True), version from etag(**view_args),
+            # or a fixed version (str, e.g. etag='v1')
+            @lazy_urls.route(r'/users/<uid>', methods=['GET'],
+                             etag=lambda uid: get_user_version(uid))
+            def user(uid):
+                return json_response(get_user(uid))
+
+            # responses cached for 60 seconds, per project of credential.
+            @lazy_urls.route(r'/quotas', methods=['GET'],
+                             cache_ttl=60, vary_on=('project',))
+            def quotas():
+                return json_response(get_quotas())
+
 
             # app/app.py
             from flask import Flask
@@ -48,7 +450,9 @@ class UrlRuleCache(object):
             app = Flask(__name__)
             lazy_urls.attach(app)
 
-
+            # or, with a manifest (saved from lazy_urls.manifest())
+            # view modules are imported on first request to their endpoints.
+            lazy_urls.attach_manifest(app, routes)
 
     """
     def __init__(self, app=None):
@@ -62,8 +466,54 @@ class UrlRuleCache(object):
         for rule, endpoint, f, options in self.cached_rule:
             app.add_url_rule(rule, endpoint, f, **options)
 
+    def attach_manifest(self, app, routes):
+        """
+            register routes of manifest to app, with LazyView as view.
+        """
+        self.app = app
+        for record in routes:
+            app.add_url_rule(record['rule'], record['endpoint'],
+                             LazyView(self, record), **record['options'])
+
+    def manifest(self):
+        """
+            output:
+                [dict] -> json-serializable records of cached rules:
+                          rule, endpoint, module, policy_rule, options
+        """
+        routes = []
+        for rule, endpoint, f, options in self.cached_rule:
+            routes.append({
+                'rule': rule,
+                'endpoint': endpoint or f.__name__,
+                'module': f.__module__,
+                'policy_rule': getattr(f, 'policy_rule', None),
+                'options': options
+            })
+        return routes
+
+    def find_view(self, rule, endpoint):
+        for _rule, _endpoint, f, options in self.cached_rule:
+            if _rule == rule and (_endpoint or f.__name__) == endpoint:
+                return f
+        return None
+
     def add_url_rule(self, rule, endpoint, f, **options):
-        self.cached_rule.append((rule, endpoint, f, options))
+        policy_rule = options.pop('policy_rule', None)
+        etag = options.pop('etag', None)
+        cache_ttl = options.pop('cache_ttl', None)
+        vary_on = options.pop('vary_on', ())
+        cache_size = options.pop('cache_size', 256)
+
+        view = f
+        if etag:
+            view = etag_view(view, etag)
+        if cache_ttl:
+            view = cached_view(view, cache_ttl, vary_on, cache_size)
+        if policy_rule is not None:
+            # collected by kapp.policy.init_policy
+            view.policy_rule = policy_rule
+        self.cached_rule.append((rule, endpoint, view, options))
 
     def route(self, rule, **options):
         def decorator(f):